@@ -0,0 +1,133 @@
+# importing libaries
+
+import os
+import glob
+import json
+import argparse
+import psycopg2
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import ETL_pipeline_functions
+import migrations
+
+# club settings
+
+## directory holding one strava credentials file per athlete (client_id, client_secret, refresh_token, athlete_id)
+athletes_dir = '.secret/athletes'
+## number of athletes ingested at once
+max_athletes = 4
+
+# tagging records with athlete ids
+
+def tag_athlete(records, athlete_id):
+
+    for record in records:
+        record['athlete_id'] = athlete_id
+
+    return records
+
+# reading athlete credentials
+
+def athlete_credentials(credentials_dir = None):
+
+    athletes = []
+
+    for credentials_file in sorted(glob.glob(os.path.join(credentials_dir or athletes_dir, '*.json'))):
+        with open(credentials_file, 'r') as r:
+            athlete_id = json.load(r).get('athlete_id')
+
+        # falling back to the file name (e.g. .secret/athletes/12345.json)
+        if athlete_id is None:
+            athlete_id = os.path.splitext(os.path.basename(credentials_file))[0]
+
+        athletes.append({'athlete_id': int(athlete_id), 'credentials_file': credentials_file})
+
+    return athletes
+
+# running one athlete's pipeline
+
+def athlete_pipeline(athlete, geocode_key, geocode_cache, batch_size = ETL_pipeline_functions.max_per_page):
+
+    athlete_id = athlete['athlete_id']
+    watermark = 'activities:{}'.format(athlete_id)
+
+    # refreshing this athlete's own access token
+    strava_access_token = ETL_pipeline_functions.strava_token_exchange(athlete['credentials_file'])
+
+    # claiming an even share of the rate limit budget while this athlete runs
+    ETL_pipeline_functions.register_rate_limit_client(strava_access_token)
+
+    n = 0
+    newest_time = None
+
+    try:
+        # walking the athlete's full history on their first run
+        start_date = ETL_pipeline_functions.read_watermark(watermark) or False
+        activities_stream = ETL_pipeline_functions.stream_activities(strava_access_token, geocode_key, start_date, geocode_cache = geocode_cache)
+
+        # creating connection to postgresSQL database, timing each athlete as a stage of the club run
+        with ETL_pipeline_functions.timed_stage('athlete_{}'.format(athlete_id)), psycopg2.connect(host="localhost", database="running_data", user="jacktann", password="Buster#19") as conn:
+            # indexing activities already in the database so their laps and zones aren't requested again
+            activity_index = ETL_pipeline_functions.load_activity_index(conn)
+
+            for activities in ETL_pipeline_functions.batched(activities_stream, batch_size):
+                activity_ids = list(map(lambda activity: activity['id'], activities))
+                splits, zones = ETL_pipeline_functions.processed_splits_and_zones(strava_access_token, activity_ids, activity_index = activity_index)
+                ETL_pipeline_functions.bulk_load(conn, tag_athlete(activities, athlete_id), tag_athlete(splits, athlete_id), tag_athlete(zones, athlete_id), activity_index)
+
+                n += len(activities)
+                newest_time = max(filter(None, [newest_time, ETL_pipeline_functions.newest_activity_time(activities)]))
+
+        print("athlete {}: {} laps and zones requests avoided".format(athlete_id, activity_index['requests_avoided']))
+
+        if n:
+            ETL_pipeline_functions.advance_watermark(watermark, newest_time)
+    finally:
+        ETL_pipeline_functions.unregister_rate_limit_client(strava_access_token)
+
+    return n
+
+# scheduling the club
+
+def ETL_club(credentials_dir = None, max_workers = max_athletes):
+    with ETL_pipeline_functions.recorded_run('ETL_club'):
+        # storing key for Google Geocoding API, shared by every athlete
+        geocode_key = ETL_pipeline_functions.geocode_key_getter('.secret/geocode_api_credentials.json')
+
+        athletes = athlete_credentials(credentials_dir)
+        if not athletes:
+            return print("no athlete credentials found")
+
+        # creating connection to postgresSQL database, bringing the schema up to date (athlete ids arrive in migration 4)
+        with psycopg2.connect(host="localhost", database="running_data", user="jacktann", password="Buster#19") as conn:
+            migrations.migrate(conn)
+
+        # loading cached locations for Google Geocoding API, shared across athletes (it's thread safe)
+        geocode_cache = ETL_pipeline_functions.load_geocode_cache('data/geocode_cache.json')
+
+        failures = 0
+
+        with ThreadPoolExecutor(max_workers = max_workers) as executor:
+            futures = {executor.submit(athlete_pipeline, athlete, geocode_key, geocode_cache): athlete['athlete_id'] for athlete in athletes}
+
+            for future in as_completed(futures):
+                athlete_id = futures[future]
+                try:
+                    print("athlete {}: {} activities loaded".format(athlete_id, future.result()))
+                except Exception as e:
+                    # leaving the athlete's watermark where it was so the next run picks up from there
+                    failures += 1
+                    print("athlete {} failed: {}".format(athlete_id, e))
+
+        ETL_pipeline_functions.save_geocode_cache(geocode_cache, 'data/geocode_cache.json')
+        print("geocode cache: {} hits, {} misses".format(geocode_cache['hits'], geocode_cache['misses']))
+
+        return print("ETL club run complete ({} of {} athletes succeeded)".format(len(athletes) - failures, len(athletes)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Run the Strava ETL pipeline for every athlete in a club.')
+    parser.add_argument('--athletes-dir', default = athletes_dir, help = 'directory of per-athlete credentials files')
+    parser.add_argument('--workers', type = int, default = max_athletes, help = 'number of athletes ingested at once')
+    args = parser.parse_args()
+
+    ETL_club(args.athletes_dir, args.workers)
@@ -0,0 +1,166 @@
+# importing libaries
+
+import os
+import argparse
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+# data lake settings
+
+## directory holding one partitioned parquet dataset per table
+lake_dir = 'data/lake'
+
+## column types for each table
+table_schemas = {
+    'activities': pa.schema([
+        ('id', pa.int64()),
+        ('timestamp', pa.timestamp('s')),
+        ('distance', pa.float64()),
+        ('time', pa.int32()),
+        ('location', pa.string()),
+        ('elevation_gain', pa.float64()),
+        ('average_speed', pa.float64()),
+        ('max_speed', pa.float64()),
+        ('average_hr', pa.float64()),
+        ('max_hr', pa.float64()),
+        ('average_cadence', pa.float64()),
+        ('kudos', pa.int32()),
+        ('suffer_score', pa.int32()),
+        ('run_type', pa.string()),
+        ('position', pa.int32()),
+        ('event_type', pa.string()),
+        ('chip_time', pa.int32()),
+        ('year', pa.int16())]),
+    'activity_splits': pa.schema([
+        ('activity_id', pa.int64()),
+        ('timestamp', pa.timestamp('s')),
+        ('split_index', pa.int16()),
+        ('distance', pa.float64()),
+        ('time', pa.int32()),
+        ('elevation_gain', pa.float64()),
+        ('average_speed', pa.float64()),
+        ('max_speed', pa.float64()),
+        ('average_hr', pa.float64()),
+        ('max_hr', pa.float64()),
+        ('average_cadence', pa.float64()),
+        ('year', pa.int16())]),
+    'activity_zones': pa.schema([
+        ('activity_id', pa.int64()),
+        ('timestamp', pa.timestamp('s')),
+        ('zone_type', pa.string()),
+        ('zone_index', pa.int16()),
+        ('time', pa.int32()),
+        ('year', pa.int16())])
+}
+
+## column holding the activity id in each table
+id_columns = {'activities': 'id', 'activity_splits': 'activity_id', 'activity_zones': 'activity_id'}
+
+# reading source tables
+
+def read_csv_tables(data_dir = 'data'):
+
+    activities = pd.read_csv(os.path.join(data_dir, 'activities.csv'))
+    splits = pd.read_csv(os.path.join(data_dir, 'activity_splits.csv'))
+    zones = pd.read_csv(os.path.join(data_dir, 'activity_zones.csv'))
+
+    # parsing dd/mm/yyyy HH:MM timestamps
+    activities['timestamp'] = pd.to_datetime(activities['timestamp'], format = '%d/%m/%Y %H:%M')
+    # dropping the stray index column written with the zones file
+    zones = zones.drop(columns = [column for column in zones.columns if column.startswith('Unnamed')])
+
+    return {'activities': activities, 'activity_splits': splits, 'activity_zones': zones}
+
+def read_db_tables(conn):
+
+    tables = {}
+
+    for table_name in table_schemas:
+        tables[table_name] = pd.read_sql_query("""SELECT * FROM {};""".format(table_name), conn)
+        tables[table_name] = tables[table_name].drop(columns = ['id'] if table_name != 'activities' else [], errors = 'ignore')
+
+    tables['activities']['timestamp'] = pd.to_datetime(tables['activities']['timestamp'])
+
+    return tables
+
+# writing parquet tables
+
+def partitioned_table(frame, table_name, activity_timestamps):
+
+    frame = frame.copy()
+
+    # carrying each activity's timestamp onto its laps and zones so date predicates can be pushed down
+    if table_name != 'activities':
+        frame['timestamp'] = frame['activity_id'].map(activity_timestamps)
+
+        # skipping rows whose activity isn't in the activities table
+        orphans = frame['timestamp'].isna().sum()
+        if orphans:
+            print("{} {} rows without a matching activity skipped".format(orphans, table_name))
+            frame = frame.dropna(subset = ['timestamp'])
+
+    frame['year'] = frame['timestamp'].dt.year
+
+    schema = table_schemas[table_name]
+    table = pa.Table.from_pandas(frame[schema.names], schema = schema, preserve_index = False)
+
+    return table
+
+def export_tables(tables, output_dir = None):
+
+    output_dir = output_dir or lake_dir
+    activity_timestamps = tables['activities'].set_index('id')['timestamp']
+
+    for table_name, frame in tables.items():
+        table = partitioned_table(frame, table_name, activity_timestamps)
+
+        # sorting rows so timestamp and id statistics prune row groups within each file
+        table = table.sort_by([('timestamp', 'ascending'), (id_columns[table_name], 'ascending')])
+        pq.write_to_dataset(
+            table,
+            os.path.join(output_dir, table_name),
+            partition_cols = ['year'],
+            existing_data_behavior = 'delete_matching')
+
+        print("{} rows written to {}".format(table.num_rows, os.path.join(output_dir, table_name)))
+
+# loading parquet tables
+
+def load_table(table_name, columns = None, start_date = None, end_date = None, activity_ids = None, input_dir = None):
+
+    dataset = ds.dataset(os.path.join(input_dir or lake_dir, table_name), format = 'parquet', partitioning = 'hive')
+
+    # building predicates that prune year partitions and row groups before reading
+    filters = []
+    if start_date is not None:
+        start_date = pd.Timestamp(start_date)
+        filters += [ds.field('year') >= start_date.year, ds.field('timestamp') >= start_date.to_pydatetime()]
+    if end_date is not None:
+        end_date = pd.Timestamp(end_date)
+        filters += [ds.field('year') <= end_date.year, ds.field('timestamp') < end_date.to_pydatetime()]
+    if activity_ids is not None:
+        filters += [ds.field(id_columns[table_name]).isin(list(activity_ids))]
+
+    expression = None
+    for condition in filters:
+        expression = condition if expression is None else expression & condition
+
+    table = dataset.to_table(columns = columns, filter = expression)
+
+    return table.to_pandas()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Export the running data tables to a parquet data lake partitioned by year.')
+    parser.add_argument('--from-db', action = 'store_true', help = 'export from the postgresSQL database instead of the csv files')
+    args = parser.parse_args()
+
+    if args.from_db:
+        import psycopg2
+        with psycopg2.connect(host="localhost", database="running_data", user="jacktann", password="Buster#19") as conn:
+            tables = read_db_tables(conn)
+    else:
+        tables = read_csv_tables()
+
+    export_tables(tables)
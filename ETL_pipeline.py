@@ -4,58 +4,493 @@ import requests, json, csv
 from datetime import datetime, timedelta
 import time
 import re
+import os
+import argparse
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
 import psycopg2
 import ETL_pipeline_functions
 
-def ETL_pipeline():
-    # storing credentials for Strava and Google Geocoding API's
-    strava_access_token = ETL_pipeline_functions.strava_token_exchange('.secret/strava_api_credentials.json')
-    geocode_key = ETL_pipeline_functions.geocode_key_getter('.secret/geocode_api_credentials.json')
+def load(conn, activities, splits, zones, activity_index = None):
+    # upserting all rows for the run in one transaction
+    rows_loaded = ETL_pipeline_functions.bulk_load(conn, activities, splits, zones, activity_index)
+
+    print(", ".join(["{} {} rows".format(n, table_name) for table_name, n in rows_loaded.items()]) + " loaded")
+
+def log_request(n):
+    # storing current date
+    date = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    # logging requests to a csv file
+    with open('data/request_log.csv', 'a', newline = '') as a:
+        csv_writer = csv.writer(a)
+        csv_writer.writerow([date, n])
+
+def hydrate_activities(activities_file, hydrations_file, strava_access_token, activity_index = None, max_workers = None):
+    # storing ids for activities not yet hydrated by an earlier attempt
+    activity_ids = [activity['id'] for activity in ETL_pipeline_functions.read_jsonl(activities_file)]
+    hydrated_ids = set(hydration['activity_id'] for hydration in ETL_pipeline_functions.read_jsonl(hydrations_file))
+    remaining_ids = [activity_id for activity_id in activity_ids if activity_id not in hydrated_ids]
+    # skipping activities already loaded by an earlier run
+    remaining_ids = ETL_pipeline_functions.skip_known_activities(activity_index, remaining_ids, requests_per_activity = 2)
+
+    # making concurrent requests to laps and zones endpoints for Strava API
+    hydrations = ({'activity_id': activity_id, 'laps': laps, 'zones': zones} for activity_id, laps, zones in ETL_pipeline_functions.requested_splits_and_zones(strava_access_token, remaining_ids, max_workers))
+    ETL_pipeline_functions.write_jsonl(hydrations, hydrations_file, mode = 'a')
+
+    return activity_ids
+
+def valid_hydrations(hydrations):
+    # dropping error bodies (e.g. {'message': 'Record Not Found', ...}) saved by runs that didn't check responses
+    return [hydration for hydration in hydrations if isinstance(hydration['laps'], list) and isinstance(hydration['zones'], list)]
 
-    # storing most recent date from request log file
-    timestamp = ETL_pipeline_functions.last_timestamp('data/request_log.csv')
-    # converting date to unix format
-    unix_time = ETL_pipeline_functions.timestamp_to_unix(timestamp)
+def fetch_stage(run_dir, strava_access_token, activity_index = None):
+    stages = ETL_pipeline_functions.read_stages(run_dir)
+    activities_file = os.path.join(run_dir, 'activities_raw.jsonl')
+    hydrations_file = os.path.join(run_dir, 'laps_zones_raw.jsonl')
 
     # making requests to activities endpoint for Strava API
-    activities = ETL_pipeline_functions.processed_activities(strava_access_token, geocode_key, unix_time)
+    if 'activities' not in stages:
+        # storing start time of the newest loaded activity
+        unix_time = ETL_pipeline_functions.read_watermark('activities')
+        # falling back to most recent date from request log file
+        if unix_time is None:
+            unix_time = ETL_pipeline_functions.timestamp_to_unix(ETL_pipeline_functions.last_timestamp('data/request_log.csv'))
+
+        n = ETL_pipeline_functions.write_jsonl(ETL_pipeline_functions.paginated_runs(strava_access_token, unix_time), activities_file)
+        ETL_pipeline_functions.complete_stage(run_dir, 'activities', after = unix_time, n = n)
+
+    activity_ids = hydrate_activities(activities_file, hydrations_file, strava_access_token, activity_index)
+
+    requests_avoided = activity_index['requests_avoided'] if activity_index else 0
+    print("{} laps and zones requests avoided for activities already loaded".format(requests_avoided))
+
+    ETL_pipeline_functions.complete_stage(run_dir, 'fetch', n = len(activity_ids), requests_avoided = requests_avoided)
+
+def streams_stage(run_dir, strava_access_token):
+    # storing ids for fetched activities
+    activity_ids = [activity['id'] for activity in ETL_pipeline_functions.read_jsonl(os.path.join(run_dir, 'activities_raw.jsonl'))]
+
+    # making concurrent requests to streams endpoint for Strava API, skipping streams already stored
+    n = ETL_pipeline_functions.processed_streams(strava_access_token, activity_ids)
+    print("{} activity streams stored".format(n))
+
+    ETL_pipeline_functions.complete_stage(run_dir, 'streams', n = n)
+
+def transform_stage(run_dir, geocode_key):
+    # loading cached locations for Google Geocoding API
+    geocode_cache = ETL_pipeline_functions.load_geocode_cache('data/geocode_cache.json')
+
+    # cleaning and engineering activities
+    raw_activities = ETL_pipeline_functions.read_jsonl(os.path.join(run_dir, 'activities_raw.jsonl'))
+    activities = ETL_pipeline_functions.engineered_activities(raw_activities, geocode_key, geocode_cache)
+    n = ETL_pipeline_functions.write_jsonl(activities, os.path.join(run_dir, 'activities.jsonl'))
+
+    # saving cached locations for future runs
+    ETL_pipeline_functions.save_geocode_cache(geocode_cache, 'data/geocode_cache.json')
+    print("geocode cache: {} hits, {} misses".format(geocode_cache['hits'], geocode_cache['misses']))
+
+    # cleaning laps and zones as whole batches
+    hydrations = valid_hydrations(ETL_pipeline_functions.read_jsonl(os.path.join(run_dir, 'laps_zones_raw.jsonl')))
+    splits = ETL_pipeline_functions.clean_splits_frame([(hydration['activity_id'], hydration['laps']) for hydration in hydrations])
+    zones = ETL_pipeline_functions.clean_zones_frame([(hydration['activity_id'], hydration['zones']) for hydration in hydrations])
+    ETL_pipeline_functions.write_jsonl(ETL_pipeline_functions.frame_records(splits), os.path.join(run_dir, 'splits.jsonl'))
+    ETL_pipeline_functions.write_jsonl(ETL_pipeline_functions.frame_records(zones), os.path.join(run_dir, 'zones.jsonl'))
+
+    ETL_pipeline_functions.complete_stage(run_dir, 'transform', n = n)
+
+def load_stage(run_dir):
+    activities = list(ETL_pipeline_functions.read_jsonl(os.path.join(run_dir, 'activities.jsonl')))
+    splits = list(ETL_pipeline_functions.read_jsonl(os.path.join(run_dir, 'splits.jsonl')))
+    zones = list(ETL_pipeline_functions.read_jsonl(os.path.join(run_dir, 'zones.jsonl')))
 
     # storing number of activities
     n = len(activities)
 
     # checking for activities
     if n:
-        # storing ids for activities
-        activity_ids = list(map(lambda activity: activity['id'], activities))
+        # creating connection to postgresSQL database
+        with psycopg2.connect(host="localhost", database="running_data", user="jacktann", password="Buster#19") as conn:
+            # keeping laps and zones of activities that were loaded before and not fetched again
+            load(conn, activities, splits, zones, ETL_pipeline_functions.load_activity_index(conn))
 
-        # making requests to laps endpoint for Strava API
-        splits = ETL_pipeline_functions.processed_splits(strava_access_token, activity_ids)
+        # advancing the watermark only once the load has committed
+        ETL_pipeline_functions.advance_watermark('activities', ETL_pipeline_functions.newest_activity_time(activities))
+        log_request(n)
 
-        # making requests to zones endpoint for Strava API
-        zones = ETL_pipeline_functions.processed_zones(strava_access_token, activity_ids)
+    ETL_pipeline_functions.complete_stage(run_dir, 'load', n = n)
+
+    return n
+
+def ETL_pipeline():
+    with ETL_pipeline_functions.recorded_run('ETL_pipeline'):
+        # resuming the newest run if it did not finish, otherwise starting a new one
+        run_dir = ETL_pipeline_functions.unfinished_run_dir('data/runs')
+        if run_dir:
+            print("resuming run {}".format(os.path.basename(run_dir)))
+        else:
+            run_dir = ETL_pipeline_functions.new_run_dir('data/runs')
+
+        stages = ETL_pipeline_functions.read_stages(run_dir)
+
+        # storing credentials for Strava API if there are requests left to make
+        if 'fetch' not in stages or 'streams' not in stages:
+            strava_access_token = ETL_pipeline_functions.strava_token_exchange('.secret/strava_api_credentials.json')
+
+        # fetching raw activities, laps and zones from Strava API
+        if 'fetch' not in stages:
+            # indexing activities already in the database so their laps and zones aren't requested again
+            with ETL_pipeline_functions.timed_stage('fetch'), psycopg2.connect(host="localhost", database="running_data", user="jacktann", password="Buster#19") as conn:
+                fetch_stage(run_dir, strava_access_token, ETL_pipeline_functions.load_activity_index(conn))
+
+        # fetching per-second streams from Strava API
+        if 'streams' not in stages:
+            with ETL_pipeline_functions.timed_stage('streams'):
+                streams_stage(run_dir, strava_access_token)
+
+        # cleaning and engineering features
+        if 'transform' not in stages:
+            geocode_key = ETL_pipeline_functions.geocode_key_getter('.secret/geocode_api_credentials.json')
+            with ETL_pipeline_functions.timed_stage('transform'):
+                transform_stage(run_dir, geocode_key)
+
+        # loading into postgresSQL database
+        with ETL_pipeline_functions.timed_stage('load'):
+            n = load_stage(run_dir)
+
+        # exception handling for no activities
+        if not n:
+            return print("no activities to append")
+
+        return print("ETL pipeline complete")
+
+def ETL_backfill(start_date = False, batch_size = ETL_pipeline_functions.max_per_page):
+    with ETL_pipeline_functions.recorded_run('ETL_backfill'):
+        # storing credentials for Strava and Google Geocoding API's
+        strava_access_token = ETL_pipeline_functions.strava_token_exchange('.secret/strava_api_credentials.json')
+        geocode_key = ETL_pipeline_functions.geocode_key_getter('.secret/geocode_api_credentials.json')
+
+        # loading cached locations for Google Geocoding API
+        geocode_cache = ETL_pipeline_functions.load_geocode_cache('data/geocode_cache.json')
+
+        # lazily walking every page of activities after the start date
+        activities_stream = ETL_pipeline_functions.stream_activities(strava_access_token, geocode_key, start_date, geocode_cache = geocode_cache)
+
+        # storing number of activities and start time of the newest one
+        n = 0
+        newest_time = None
 
         # creating connection to postgresSQL database
         with psycopg2.connect(host="localhost", database="running_data", user="jacktann", password="Buster#19") as conn:
+            # indexing activities already in the database so their laps and zones aren't requested again
+            activity_index = ETL_pipeline_functions.load_activity_index(conn)
+
+            # hydrating and loading one batch at a time so memory stays constant
+            for activities in ETL_pipeline_functions.batched(activities_stream, batch_size):
+                activity_ids = list(map(lambda activity: activity['id'], activities))
+                with ETL_pipeline_functions.timed_stage('laps_zones'):
+                    splits, zones = ETL_pipeline_functions.processed_splits_and_zones(strava_access_token, activity_ids, activity_index = activity_index)
+                with ETL_pipeline_functions.timed_stage('load'):
+                    load(conn, activities, splits, zones, activity_index)
+
+                n += len(activities)
+                newest_time = max(filter(None, [newest_time, ETL_pipeline_functions.newest_activity_time(activities)]))
+                print("{} activities backfilled".format(n))
+
+                # saving cached locations after each batch
+                ETL_pipeline_functions.save_geocode_cache(geocode_cache, 'data/geocode_cache.json')
+
+        print("geocode cache: {} hits, {} misses".format(geocode_cache['hits'], geocode_cache['misses']))
+        print("{} laps and zones requests avoided for activities already loaded".format(activity_index['requests_avoided']))
+
+        if not n:
+            return print("no activities to append")
+
+        # advancing the watermark only once the whole history has loaded, as pages may arrive newest first
+        ETL_pipeline_functions.advance_watermark('activities', newest_time)
+
+        log_request(n)
+
+        return print("ETL backfill complete")
+
+# backfill sharded into date windows fetched in parallel
+
+def shard_stage(run_dir, shard, window, strava_access_token, activity_index, max_workers):
+    activities_file = os.path.join(run_dir, '{}_activities_raw.jsonl'.format(shard))
+    hydrations_file = os.path.join(run_dir, '{}_laps_zones_raw.jsonl'.format(shard))
+
+    # making requests to activities endpoint for Strava API, rewriting the window if it was cut short
+    if '{}_activities'.format(shard) not in ETL_pipeline_functions.read_stages(run_dir):
+        n = ETL_pipeline_functions.write_jsonl(ETL_pipeline_functions.paginated_runs(strava_access_token, window[0], end_date = window[1]), activities_file)
+        ETL_pipeline_functions.complete_stage(run_dir, '{}_activities'.format(shard), n = n)
+
+    # hydrating the window's runs, keeping laps and zones fetched before an interruption
+    activity_ids = hydrate_activities(activities_file, hydrations_file, strava_access_token, activity_index, max_workers)
+
+    ETL_pipeline_functions.complete_stage(run_dir, shard, after = window[0], before = window[1], n = len(activity_ids))
+
+    return len(activity_ids)
+
+def merged_shards(run_dir, shards, batch_size = ETL_pipeline_functions.max_per_page):
+    seen_ids = set()
+
+    # indexing every window's laps and zones by activity id, as overlapping windows may hydrate an activity in either
+    hydration_offsets = {}
+    for shard in shards:
+        hydrations_file = os.path.join(run_dir, '{}_laps_zones_raw.jsonl'.format(shard))
+        for activity_id, offset in ETL_pipeline_functions.jsonl_offsets(hydrations_file, 'activity_id').items():
+            hydration_offsets.setdefault(activity_id, (hydrations_file, offset))
+
+    # streaming each window's runs a batch at a time, holding only activity ids and file offsets in memory
+    for shard in shards:
+        for batch in ETL_pipeline_functions.batched(ETL_pipeline_functions.read_jsonl(os.path.join(run_dir, '{}_activities_raw.jsonl'.format(shard))), batch_size):
+            # dropping activities fetched by two overlapping windows
+            activities = []
+            for activity in batch:
+                if activity['id'] not in seen_ids:
+                    seen_ids.add(activity['id'])
+                    activities.append(activity)
+
+            if not activities:
+                continue
+
+            # reading back only the batch's laps and zones
+            batch_offsets = {}
             for activity in activities:
-                ETL_pipeline_functions.commit(conn, ETL_pipeline_functions.insert_statement("activities", activity))
+                if activity['id'] in hydration_offsets:
+                    hydrations_file, offset = hydration_offsets[activity['id']]
+                    batch_offsets.setdefault(hydrations_file, []).append(offset)
+            hydrations = valid_hydrations(hydration for hydrations_file, offsets in batch_offsets.items() for hydration in ETL_pipeline_functions.read_jsonl_at(hydrations_file, offsets))
 
-            for zone in zones:
-                ETL_pipeline_functions.commit(conn, ETL_pipeline_functions.insert_statement("activity_zones", zone))
+            yield activities, hydrations
 
-            for split in splits:
-                ETL_pipeline_functions.commit(conn, ETL_pipeline_functions.insert_statement("activity_splits", split))
+def check_backfill_plan(run_dir, plan, start_date, end_date, window_days):
+    # comparing the options given with the ones the unfinished backfill was planned with
+    planned = {'--after': plan['windows'][0][0] + 1 if plan['windows'] else None, 'end date': plan['windows'][-1][1] if plan['windows'] else None, '--window-days': plan.get('window_days')}
+    given = {'--after': start_date or None, 'end date': end_date, '--window-days': window_days}
+    differing = [option for option in given if given[option] is not None and planned[option] is not None and given[option] != planned[option]]
 
-    # exception handling for no activities
-    else:
-        return print("no activities to append")
-    
-    # storing current date
-    date = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    # logging requests to a csv file
-    with open('data/request_log.csv', 'a', newline = '') as a:
-        csv_writer = csv.writer(a)
-        csv_writer.writerow([date, n])
-    
-    return print("ETL pipeline complete")
+    if differing:
+        raise ValueError("backfill {} was planned with a different {}, finish it without them or remove {} to plan a new one".format(os.path.basename(run_dir), ', '.join(differing), run_dir))
+
+def ETL_sharded_backfill(start_date = False, end_date = None, window_days = None, n_shards = 4, batch_size = ETL_pipeline_functions.max_per_page):
+    with ETL_pipeline_functions.recorded_run('ETL_sharded_backfill'):
+        # resuming the newest backfill if it did not finish, otherwise planning a new one
+        run_dir = ETL_pipeline_functions.unfinished_run_dir('data/backfills')
+        if run_dir:
+            print("resuming backfill {}".format(os.path.basename(run_dir)))
+            check_backfill_plan(run_dir, ETL_pipeline_functions.read_stages(run_dir)['plan'], start_date, end_date, window_days)
+        else:
+            run_dir = ETL_pipeline_functions.new_run_dir('data/backfills')
+            start_date = start_date or ETL_pipeline_functions.timestamp_to_unix(ETL_pipeline_functions.backfill_start_date)
+            end_date = end_date or int(time.time())
+            window_days = window_days or ETL_pipeline_functions.backfill_window_days
+            windows = ETL_pipeline_functions.date_windows(start_date, end_date, window_days)
+            ETL_pipeline_functions.complete_stage(run_dir, 'plan', windows = windows, window_days = window_days)
+
+        stages = ETL_pipeline_functions.read_stages(run_dir)
+        windows = stages['plan']['windows']
+        shards = ['shard_{}'.format(i) for i in range(len(windows))]
+        remaining = [(shard, window) for shard, window in zip(shards, windows) if shard not in stages]
+        print("{} of {} windows left to fetch".format(len(remaining), len(windows)))
+
+        # storing credentials for Strava and Google Geocoding API's
+        strava_access_token = ETL_pipeline_functions.strava_token_exchange('.secret/strava_api_credentials.json')
+        geocode_key = ETL_pipeline_functions.geocode_key_getter('.secret/geocode_api_credentials.json')
+
+        # creating connection to postgresSQL database
+        with psycopg2.connect(host="localhost", database="running_data", user="jacktann", password="Buster#19") as conn:
+            # indexing activities already in the database so their laps and zones aren't requested again
+            activity_index = ETL_pipeline_functions.load_activity_index(conn)
+
+            # fetching windows in parallel, splitting the request slots between them (all share one rate budget)
+            max_workers = max(1, ETL_pipeline_functions.max_concurrent_requests // n_shards)
+            with ETL_pipeline_functions.timed_stage('fetch'), ThreadPoolExecutor(max_workers = n_shards) as executor:
+                futures = [executor.submit(shard_stage, run_dir, shard, window, strava_access_token, activity_index, max_workers) for shard, window in remaining]
+                for future in futures:
+                    future.result()
+
+            print("{} laps and zones requests avoided for activities already loaded".format(activity_index['requests_avoided']))
+
+            geocode_cache = ETL_pipeline_functions.load_geocode_cache('data/geocode_cache.json')
+            n = 0
+            newest_time = None
+
+            # merging the windows into one deduplicated history, engineering and loading a batch at a time
+            with ETL_pipeline_functions.timed_stage('transform_load'):
+                for batch, batch_hydrations in merged_shards(run_dir, shards, batch_size):
+                    engineered = list(ETL_pipeline_functions.engineered_activities(batch, geocode_key, geocode_cache))
+                    splits = ETL_pipeline_functions.clean_splits_frame([(hydration['activity_id'], hydration['laps']) for hydration in batch_hydrations])
+                    zones = ETL_pipeline_functions.clean_zones_frame([(hydration['activity_id'], hydration['zones']) for hydration in batch_hydrations])
+                    load(conn, engineered, ETL_pipeline_functions.frame_records(splits), ETL_pipeline_functions.frame_records(zones), activity_index)
+
+                    n += len(engineered)
+                    newest_time = max(filter(None, [newest_time, ETL_pipeline_functions.newest_activity_time(engineered)]))
+
+            print("{} activities loaded across {} windows".format(n, len(windows)))
+            ETL_pipeline_functions.save_geocode_cache(geocode_cache, 'data/geocode_cache.json')
+
+        ETL_pipeline_functions.complete_stage(run_dir, 'load', n = n)
+
+        if not n:
+            return print("no activities to append")
+
+        ETL_pipeline_functions.advance_watermark('activities', newest_time)
+        log_request(n)
+
+        return print("ETL sharded backfill complete")
+
+# asyncio pipeline overlapping fetch, engineer and load stages
+
+async def fetch_activities(loop, raw_queue, activities_iterator, n_workers):
+    # pulling raw runs page by page, waiting whenever the queue is full
+    while True:
+        activity = await loop.run_in_executor(None, next, activities_iterator, None)
+        if activity is None:
+            break
+        await raw_queue.put(activity)
+
+    # telling each engineer worker there is nothing left
+    for _ in range(n_workers):
+        await raw_queue.put(None)
 
-ETL_pipeline()
\ No newline at end of file
+async def engineer_activities(loop, raw_queue, load_queue, strava_access_token, geocode_key, geocode_cache, activity_index):
+    while True:
+        raw_activity = await raw_queue.get()
+        if raw_activity is None:
+            return await load_queue.put(None)
+
+        activity_id = raw_activity['id']
+
+        # engineering only, keeping the stored laps and zones of activities already loaded
+        # (checked off the event loop, as a bloom filter hit is confirmed with a database query)
+        if not await loop.run_in_executor(None, functools.partial(ETL_pipeline_functions.skip_known_activities, activity_index, [activity_id], requests_per_activity = 2)):
+            activity = await loop.run_in_executor(None, lambda activities: list(ETL_pipeline_functions.engineered_activities(activities, geocode_key, geocode_cache))[0], [raw_activity])
+            await load_queue.put((activity, [], []))
+            continue
+
+        # engineering the activity while its laps and zones are requested
+        activity, splits_response, zones_response = await asyncio.gather(
+            loop.run_in_executor(None, lambda activities: list(ETL_pipeline_functions.engineered_activities(activities, geocode_key, geocode_cache))[0], [raw_activity]),
+            loop.run_in_executor(None, ETL_pipeline_functions.request_splits, strava_access_token, activity_id),
+            loop.run_in_executor(None, ETL_pipeline_functions.request_zones, strava_access_token, activity_id))
+
+        # leaving out laps and zones of activities deleted since they were listed
+        splits = ETL_pipeline_functions.clean_splits(splits_response, activity_id) if splits_response is not None else []
+        zones = ETL_pipeline_functions.clean_zones(zones_response, activity_id) if zones_response is not None else []
+        await load_queue.put((activity, splits, zones))
+
+async def load_activities(loop, load_queue, conn, n_workers, batch_size, activity_index):
+    finished_workers = 0
+    n = 0
+    newest_time = None
+
+    while finished_workers < n_workers:
+        # waiting for the first hydrated activity, then taking whatever else is ready
+        items = [await load_queue.get()]
+        while len(items) < batch_size and not load_queue.empty():
+            items.append(load_queue.get_nowait())
+
+        finished_workers += items.count(None)
+        hydrated = [item for item in items if item is not None]
+        if not hydrated:
+            continue
+
+        activities = [activity for activity, splits, zones in hydrated]
+        splits = [split for activity, activity_splits, zones in hydrated for split in activity_splits]
+        zones = [zone for activity, splits, activity_zones in hydrated for zone in activity_zones]
+        with ETL_pipeline_functions.timed_stage('load'):
+            await loop.run_in_executor(None, functools.partial(load, conn, activities, splits, zones, activity_index))
+
+        n += len(activities)
+        newest_time = max(filter(None, [newest_time, ETL_pipeline_functions.newest_activity_time(activities)]))
+
+    return n, newest_time
+
+async def async_pipeline(start_date, queue_size, n_workers, batch_size):
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers = 3 * n_workers + 2))
+
+    # storing credentials for Strava and Google Geocoding API's
+    strava_access_token = ETL_pipeline_functions.strava_token_exchange('.secret/strava_api_credentials.json')
+    geocode_key = ETL_pipeline_functions.geocode_key_getter('.secret/geocode_api_credentials.json')
+    geocode_cache = ETL_pipeline_functions.load_geocode_cache('data/geocode_cache.json')
+
+    # bounding both queues so a multi-year backfill can't outrun the database
+    raw_queue = asyncio.Queue(maxsize = queue_size)
+    load_queue = asyncio.Queue(maxsize = queue_size)
+    activities_iterator = iter(ETL_pipeline_functions.paginated_runs(strava_access_token, start_date))
+
+    # creating connection to postgresSQL database
+    with psycopg2.connect(host="localhost", database="running_data", user="jacktann", password="Buster#19") as conn, psycopg2.connect(host="localhost", database="running_data", user="jacktann", password="Buster#19") as index_conn:
+        # indexing activities already in the database so their laps and zones aren't requested again, on a connection of
+        # its own so confirming bloom filter hits never runs inside the load stage's transaction
+        activity_index = ETL_pipeline_functions.load_activity_index(index_conn)
+        index_conn.autocommit = True
+
+        workers = [engineer_activities(loop, raw_queue, load_queue, strava_access_token, geocode_key, geocode_cache, activity_index) for _ in range(n_workers)]
+        _, *_, (n, newest_time) = await asyncio.gather(
+            fetch_activities(loop, raw_queue, activities_iterator, n_workers),
+            *workers,
+            load_activities(loop, load_queue, conn, n_workers, batch_size, activity_index))
+
+    ETL_pipeline_functions.save_geocode_cache(geocode_cache, 'data/geocode_cache.json')
+    print("geocode cache: {} hits, {} misses".format(geocode_cache['hits'], geocode_cache['misses']))
+    print("{} laps and zones requests avoided for activities already loaded".format(activity_index['requests_avoided']))
+
+    return n, newest_time
+
+def ETL_pipeline_async(start_date = None, queue_size = 50, n_workers = ETL_pipeline_functions.max_concurrent_requests, batch_size = 50):
+    with ETL_pipeline_functions.recorded_run('ETL_pipeline_async'):
+        # storing start time of the newest loaded activity
+        if start_date is None:
+            start_date = ETL_pipeline_functions.read_watermark('activities')
+        # falling back to most recent date from request log file
+        if start_date is None:
+            start_date = ETL_pipeline_functions.timestamp_to_unix(ETL_pipeline_functions.last_timestamp('data/request_log.csv'))
+
+        n, newest_time = asyncio.run(async_pipeline(start_date, queue_size, n_workers, batch_size))
+
+        if not n:
+            return print("no activities to append")
+
+        # advancing the watermark once every activity has loaded, as they finish out of order
+        ETL_pipeline_functions.advance_watermark('activities', newest_time)
+        log_request(n)
+
+        return print("ETL pipeline complete")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Load new Strava activities into the running_data database.')
+    parser.add_argument('--backfill', action = 'store_true', help = 'walk the full activity history page by page')
+    parser.add_argument('--after', help = 'start date for a backfill (YYYY-MM-DD)')
+    parser.add_argument('--async', dest = 'run_async', action = 'store_true', help = 'overlap fetching, engineering and loading with asyncio')
+    parser.add_argument('--shards', type = int, help = 'backfill date windows in parallel with this many shards')
+    parser.add_argument('--window-days', type = int, help = 'length of each backfill window (days, defaults to {})'.format(ETL_pipeline_functions.backfill_window_days))
+    parser.add_argument('--rebuild-rollups', action = 'store_true', help = 'recompute the weekly rollup tables from the whole history')
+    parser.add_argument('--check-rollups', action = 'store_true', help = 'check the weekly rollup tables match a full rebuild (without changing them)')
+    args = parser.parse_args()
+
+    if args.check_rollups:
+        with psycopg2.connect(host="localhost", database="running_data", user="jacktann", password="Buster#19") as conn:
+            mismatched_weeks = ETL_pipeline_functions.verify_rollups(conn)
+        for table_name, weeks in mismatched_weeks.items():
+            print("{} differs from a rebuild in {} weeks, first {}".format(table_name, len(weeks), weeks[0]))
+        print("weekly rollups {}".format('need rebuilding (--rebuild-rollups)' if mismatched_weeks else 'match a full rebuild'))
+    elif args.rebuild_rollups:
+        with psycopg2.connect(host="localhost", database="running_data", user="jacktann", password="Buster#19") as conn:
+            ETL_pipeline_functions.refresh_rollups(conn)
+            ETL_pipeline_functions.notify_data_changed(conn, ETL_pipeline_functions.rollup_tables)
+            conn.commit()
+        print("weekly rollups rebuilt")
+    elif args.shards:
+        start_date = ETL_pipeline_functions.timestamp_to_unix(args.after + ' 00:00:00') if args.after else False
+        ETL_sharded_backfill(start_date, window_days = args.window_days, n_shards = args.shards)
+    elif args.run_async:
+        start_date = ETL_pipeline_functions.timestamp_to_unix(args.after + ' 00:00:00') if args.after else (False if args.backfill else None)
+        ETL_pipeline_async(start_date)
+    elif args.backfill:
+        start_date = ETL_pipeline_functions.timestamp_to_unix(args.after + ' 00:00:00') if args.after else False
+        ETL_backfill(start_date)
+    else:
+        ETL_pipeline()
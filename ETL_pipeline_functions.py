@@ -3,9 +3,516 @@
 import numpy as np
 import pandas as pd
 import requests, json, csv
+import calendar
 from datetime import datetime, timedelta
 import time
 import re
+import math
+import os
+import shutil
+import tempfile
+import atexit
+import threading
+from collections import OrderedDict
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+from psycopg2.extras import execute_values
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# API settings
+
+## base url for Strava API (can be pointed at a local stub server)
+strava_base_url = "https://www.strava.com/api/v3"
+## base url for Google Maps API (can be pointed at a local stub server)
+geocode_base_url = "https://maps.googleapis.com/maps/api"
+## maximum number of requests in flight to the Strava API
+max_concurrent_requests = 8
+## maximum page size accepted by the Strava activities endpoint
+max_per_page = 200
+
+# HTTP client settings
+
+## seconds to wait to connect and to receive a response
+http_timeout = (5, 30)
+## number of retries on connection errors and 5xx responses (429s are paced by the rate limit functions instead)
+http_retries = 5
+## exponential backoff between retries (0.5s, 1s, 2s, ...)
+http_backoff_factor = 0.5
+## keep-alive connections held open per host
+http_pool_size = max_concurrent_requests
+
+# rate limit settings
+
+## file persisting Strava quota usage between runs
+rate_limit_file = 'data/rate_limit_state.json'
+## requests held back from each Strava quota as a safety margin
+rate_limit_margin = 2
+## lengths of the short and daily Strava rate limit windows (seconds)
+rate_limit_windows = [15 * 60, 24 * 60 * 60]
+
+# token settings
+
+## seconds before expiry at which a cached access token is refreshed
+token_expiry_margin = 10 * 60
+
+# streams settings
+
+## directory holding one folder of packed arrays per activity
+streams_dir = 'data/streams'
+## per-second streams to store and their packed types
+stream_dtypes = {
+    'time': 'int32',
+    'distance': 'float32',
+    'heartrate': 'int16',
+    'velocity_smooth': 'float32',
+    'cadence': 'int16',
+    'altitude': 'float32'
+}
+
+# backfill settings
+
+## earliest date a backfill searches from when none is given (Strava's launch)
+backfill_start_date = '2009-01-01 00:00:00'
+## length of each backfill shard's time window (days)
+backfill_window_days = 90
+
+# watermark settings
+
+## file recording the high-water mark of each endpoint
+watermark_file = 'data/watermarks.json'
+
+# activity index settings
+
+## number of loaded activities above which the id index switches from a set to a Bloom filter
+activity_index_bloom_threshold = 1000000
+## share of unloaded ids the Bloom filter may report as loaded (confirmed against the database)
+activity_index_false_positive_rate = 0.001
+
+# geocode cache settings
+
+## size of the grid cells used to key cached locations (degrees, roughly 110m of latitude)
+geocode_cell_size = 0.001
+## distance within which a cached location is reused (metres)
+geocode_radius = 250
+## maximum number of cached locations before least recently used ones are evicted
+geocode_cache_size = 1000
+
+# weekly rollup settings
+
+## number of previous weeks the moving averages and std look back over
+rollup_weeks = 6
+## channel the app listens on for committed changes (the payload lists the changed tables)
+data_changed_channel = 'running_data_changed'
+
+# metrics settings
+
+## file each run appends its metrics to as a json line
+metrics_file = 'data/metrics.jsonl'
+## optional Prometheus text file rewritten after each run (e.g. for node_exporter's textfile collector)
+prometheus_file = None
+## upper bounds of the HTTP latency histogram buckets (seconds)
+latency_buckets = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+# HTTP client functions
+
+http_session = None
+http_session_lock = threading.Lock()
+
+def configure_http_session(pool_size = None, retries = None, backoff_factor = None):
+
+    global http_session
+
+    # retrying GETs only, as the OAuth refresh POST rotates refresh tokens and isn't safe to repeat
+    # (urllib3 1.26 renamed method_whitelist, which app/requirements.txt's 1.25.8 still uses, to allowed_methods)
+    retry_methods = {'allowed_methods' if hasattr(Retry, 'DEFAULT_ALLOWED_METHODS') else 'method_whitelist': frozenset(['GET'])}
+
+    retry = Retry(
+        total = http_retries if retries is None else retries,
+        backoff_factor = http_backoff_factor if backoff_factor is None else backoff_factor,
+        # leaving 429s to http_request, so every retry is paced and counted against the Strava rate limits
+        status_forcelist = [500, 502, 503, 504],
+        respect_retry_after_header = True,
+        # returning the last response once retries run out, as a single request would
+        raise_on_status = False,
+        **retry_methods)
+    adapter = HTTPAdapter(pool_maxsize = pool_size or http_pool_size, max_retries = retry)
+
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    with http_session_lock:
+        if http_session is not None:
+            http_session.close()
+        http_session = session
+
+    return session
+
+def get_http_session():
+
+    with http_session_lock:
+        session = http_session
+
+    return session or configure_http_session()
+
+def http_request(method, url, **kwargs):
+
+    kwargs.setdefault('timeout', http_timeout)
+
+    # pacing requests to the Strava API within its rate limits
+    if not url.startswith(strava_base_url):
+        start = time.perf_counter()
+        response = get_http_session().request(method, url, **kwargs)
+        record_request(url, response, time.perf_counter() - start)
+        return response
+
+    while True:
+        acquire_rate_limit(kwargs.get('headers', {}).get('Authorization'))
+        start = time.perf_counter()
+        response = get_http_session().request(method, url, **kwargs)
+        record_request(url, response, time.perf_counter() - start)
+        update_rate_limit(response)
+
+        if response.status_code != 429:
+            return response
+
+        # backing off ourselves when a 429 doesn't say which window is spent
+        if 'X-RateLimit-Usage' not in response.headers:
+            time.sleep(int(response.headers.get('Retry-After', 60)))
+
+# state file functions
+
+def atomic_write_json(data, file_name):
+
+    # writing to a temporary file then renaming so readers never see a partial file
+    # (each write gets its own temporary file, as threads and processes may write the same file at once)
+    fd, temp_file_name = tempfile.mkstemp(dir = os.path.dirname(file_name) or '.', prefix = os.path.basename(file_name) + '.', suffix = '.tmp')
+    try:
+        with os.fdopen(fd, 'w') as w:
+            json.dump(data, w)
+            w.flush()
+            os.fsync(w.fileno())
+        os.replace(temp_file_name, file_name)
+    except BaseException:
+        os.remove(temp_file_name)
+        raise
+
+# metrics functions
+
+metrics = None
+metrics_lock = threading.RLock()
+
+def reset_metrics(pipeline):
+
+    global metrics
+
+    with metrics_lock:
+        metrics = {
+            'pipeline': pipeline,
+            'started_at': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'stages': {},
+            'http': {},
+            'counters': {},
+            'rows': {}}
+
+    return metrics
+
+def get_metrics():
+
+    if metrics is None:
+        reset_metrics(None)
+
+    return metrics
+
+def endpoint_name(url):
+
+    # grouping requests by endpoint with activity ids taken out (e.g. activities/{id}/laps)
+    if url.startswith(strava_base_url):
+        path = url[len(strava_base_url):].split('?')[0].strip('/')
+    else:
+        parts = urlsplit(url)
+        path = parts.netloc + parts.path
+
+    return re.sub(r'(?<=/)\d+(?=/|$)', '{id}', path)
+
+def record_request(url, response, elapsed):
+
+    endpoint = endpoint_name(url)
+    n_bytes = len(response.content)
+
+    with metrics_lock:
+        endpoint_metrics = get_metrics()['http'].setdefault(endpoint, {'count': 0, 'errors': 0, 'bytes': 0, 'seconds': 0.0, 'buckets': [0] * len(latency_buckets)})
+        endpoint_metrics['count'] += 1
+        endpoint_metrics['errors'] += response.status_code >= 400
+        endpoint_metrics['bytes'] += n_bytes
+        endpoint_metrics['seconds'] += elapsed
+
+        # counting cumulatively as Prometheus histograms do
+        for i, bound in enumerate(latency_buckets):
+            if elapsed <= bound:
+                endpoint_metrics['buckets'][i] += 1
+
+def count_metric(name, n = 1):
+
+    with metrics_lock:
+        counters = get_metrics()['counters']
+        counters[name] = counters.get(name, 0) + n
+
+def record_rows(rows_loaded):
+
+    with metrics_lock:
+        rows = get_metrics()['rows']
+        for table_name, n in rows_loaded.items():
+            rows[table_name] = rows.get(table_name, 0) + n
+
+@contextmanager
+def timed_stage(stage):
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        # adding up stages that run more than once (e.g. loading each backfill batch)
+        with metrics_lock:
+            stages = get_metrics()['stages']
+            stages[stage] = stages.get(stage, 0) + elapsed
+
+@contextmanager
+def recorded_run(pipeline):
+
+    # writing the run's metrics even when it fails, so failed runs show up too
+    reset_metrics(pipeline)
+    status = 'failed'
+    try:
+        yield
+        status = 'complete'
+    finally:
+        write_metrics(status)
+
+def prometheus_metrics(run_metrics):
+
+    labels = 'pipeline="{}"'.format(run_metrics['pipeline'])
+    lines = []
+
+    lines.append("# TYPE etl_stage_seconds gauge")
+    for stage, seconds in run_metrics['stages'].items():
+        lines.append('etl_stage_seconds{{{},stage="{}"}} {:.6f}'.format(labels, stage, seconds))
+
+    lines.append("# TYPE etl_http_request_duration_seconds histogram")
+    for endpoint, endpoint_metrics in run_metrics['http'].items():
+        endpoint_labels = '{},endpoint="{}"'.format(labels, endpoint)
+        for bound, n in zip(latency_buckets, endpoint_metrics['buckets']):
+            lines.append('etl_http_request_duration_seconds_bucket{{{},le="{}"}} {}'.format(endpoint_labels, bound, n))
+        lines.append('etl_http_request_duration_seconds_bucket{{{},le="+Inf"}} {}'.format(endpoint_labels, endpoint_metrics['count']))
+        lines.append('etl_http_request_duration_seconds_sum{{{}}} {:.6f}'.format(endpoint_labels, endpoint_metrics['seconds']))
+        lines.append('etl_http_request_duration_seconds_count{{{}}} {}'.format(endpoint_labels, endpoint_metrics['count']))
+
+    for name, key in [('etl_http_errors', 'errors'), ('etl_http_response_bytes', 'bytes')]:
+        lines.append("# TYPE {} gauge".format(name))
+        for endpoint, endpoint_metrics in run_metrics['http'].items():
+            lines.append('{}{{{},endpoint="{}"}} {}'.format(name, labels, endpoint, endpoint_metrics[key]))
+
+    lines.append("# TYPE etl_rows_loaded gauge")
+    for table_name, n in run_metrics['rows'].items():
+        lines.append('etl_rows_loaded{{{},table="{}"}} {}'.format(labels, table_name, n))
+
+    for name, n in run_metrics['counters'].items():
+        lines.append("# TYPE etl_{} gauge".format(name))
+        lines.append('etl_{}{{{}}} {}'.format(name, labels, n))
+
+    lines.append("# TYPE etl_run_seconds gauge")
+    lines.append('etl_run_seconds{{{}}} {:.6f}'.format(labels, run_metrics['seconds']))
+
+    return "\n".join(lines) + "\n"
+
+def write_metrics(status = 'complete', file_name = None, prometheus_file_name = None):
+
+    with metrics_lock:
+        run_metrics = json.loads(json.dumps(get_metrics()))
+
+    run_metrics['status'] = status
+    run_metrics['seconds'] = (datetime.utcnow() - datetime.strptime(run_metrics['started_at'], '%Y-%m-%dT%H:%M:%SZ')).total_seconds()
+
+    # appending one line per run so runs can be compared over time
+    with open(file_name or metrics_file, 'a') as a:
+        a.write(json.dumps(run_metrics) + "\n")
+
+    prometheus_file_name = prometheus_file_name or prometheus_file
+    if prometheus_file_name:
+        with open(prometheus_file_name + '.tmp', 'w') as w:
+            w.write(prometheus_metrics(run_metrics))
+        os.replace(prometheus_file_name + '.tmp', prometheus_file_name)
+
+    return run_metrics
+
+# watermark functions
+
+def read_watermarks(state_file = None):
+
+    try:
+        with open(state_file or watermark_file, 'r') as r:
+            watermarks = json.load(r)
+    except FileNotFoundError:
+        watermarks = {}
+
+    return watermarks
+
+def read_watermark(endpoint, state_file = None):
+
+    return read_watermarks(state_file).get(endpoint)
+
+## watermarks of several endpoints (e.g. club athletes) can advance on several threads
+watermark_lock = threading.Lock()
+
+def advance_watermark(endpoint, value, state_file = None):
+
+    # reading, updating and writing under the lock so one thread's update never overwrites another's
+    with watermark_lock:
+        watermarks = read_watermarks(state_file)
+
+        # only ever moving a watermark forwards
+        if watermarks.get(endpoint) is None or value > watermarks[endpoint]:
+            watermarks[endpoint] = value
+            atomic_write_json(watermarks, state_file or watermark_file)
+
+    return watermarks[endpoint]
+
+def newest_activity_time(activities):
+
+    # using the UTC start time, as Strava's after cursor is UTC and local timestamps are skewed by the athlete's timezone
+    missing_ids = [activity['id'] for activity in activities if 'start_time' not in activity]
+    if missing_ids:
+        raise ValueError("activities {} have no start_time to advance the watermark from".format(missing_ids[:5]))
+
+    return max(activity['start_time'] for activity in activities)
+
+# rate limit functions
+
+class RateLimitExceeded(Exception):
+    pass
+
+rate_limit_state = None
+rate_limit_lock = threading.RLock()
+
+def load_rate_limit_state(state_file = None):
+
+    try:
+        with open(state_file or rate_limit_file, 'r') as r:
+            state = json.load(r)
+    except FileNotFoundError:
+        # starting from Strava's default limits until headers say otherwise
+        state = {'limits': [100, 1000], 'usage': [0, 0], 'updated_at': 0}
+
+    return state
+
+def save_rate_limit_state(state_file = None):
+
+    with rate_limit_lock:
+        if rate_limit_state is not None:
+            atomic_write_json(rate_limit_state, state_file or rate_limit_file)
+
+def get_rate_limit_state():
+
+    global rate_limit_state
+
+    with rate_limit_lock:
+        if rate_limit_state is None:
+            rate_limit_state = load_rate_limit_state()
+            # persisting quota usage however the run ends
+            atexit.register(save_rate_limit_state)
+
+        return rate_limit_state
+
+def window_start(timestamp, window):
+
+    # Strava windows reset on natural boundaries (quarter hours and midnight UTC)
+    return timestamp - timestamp % window
+
+def refresh_rate_limit_windows(state, now):
+
+    for i, window in enumerate(rate_limit_windows):
+        if window_start(state['updated_at'], window) < window_start(now, window):
+            state['usage'][i] = 0
+            for client_usage in rate_limit_clients.values():
+                client_usage[i] = 0
+
+    state['updated_at'] = now
+
+# clients sharing the budget (e.g. one per athlete), keyed by their Authorization header
+rate_limit_clients = {}
+
+def register_rate_limit_client(strava_access_token):
+
+    with rate_limit_lock:
+        rate_limit_clients.setdefault("Bearer {}".format(strava_access_token), [0, 0])
+
+def unregister_rate_limit_client(strava_access_token):
+
+    with rate_limit_lock:
+        rate_limit_clients.pop("Bearer {}".format(strava_access_token), None)
+
+def client_share(limit):
+
+    # splitting the budget evenly between registered clients
+    return (limit - rate_limit_margin) / max(len(rate_limit_clients), 1)
+
+def acquire_rate_limit(client = None):
+
+    while True:
+        with rate_limit_lock:
+            state = get_rate_limit_state()
+            now = time.time()
+            refresh_rate_limit_windows(state, now)
+            client_usage = rate_limit_clients.get(client)
+
+            if state['usage'][1] + rate_limit_margin >= state['limits'][1]:
+                raise RateLimitExceeded("daily Strava quota used ({}/{}), defer until midnight UTC".format(state['usage'][1], state['limits'][1]))
+            if client_usage and client_usage[1] >= client_share(state['limits'][1]):
+                raise RateLimitExceeded("daily share of Strava quota used ({}), defer until midnight UTC".format(client_usage[1]))
+
+            # reserving a request from both budgets, within this client's fair share
+            within_budget = state['usage'][0] + rate_limit_margin < state['limits'][0]
+            within_share = client_usage is None or client_usage[0] < client_share(state['limits'][0])
+            if within_budget and within_share:
+                state['usage'][0] += 1
+                state['usage'][1] += 1
+                if client_usage is not None:
+                    client_usage[0] += 1
+                    client_usage[1] += 1
+                return
+
+            wait = window_start(now, rate_limit_windows[0]) + rate_limit_windows[0] - now
+
+        if within_budget:
+            # re-checking shortly in case another client finishes and its share frees up
+            time.sleep(min(wait + 1, 5))
+        else:
+            print("15 minute Strava quota used, waiting {:.0f}s".format(wait))
+            time.sleep(wait + 1)
+
+def update_rate_limit(response):
+
+    limits = response.headers.get('X-RateLimit-Limit')
+    usage = response.headers.get('X-RateLimit-Usage')
+
+    if not (limits and usage):
+        return
+
+    with rate_limit_lock:
+        state = get_rate_limit_state()
+        refresh_rate_limit_windows(state, time.time())
+        state['limits'] = [int(limit) for limit in limits.split(',')[:2]]
+        # keeping local reservations for requests still in flight
+        state['usage'] = [max(int(used), reserved) for used, reserved in zip(usage.split(',')[:2], state['usage'])]
+
+        # treating a rejected request as a spent short window
+        if response.status_code == 429:
+            state['usage'][0] = state['limits'][0]
 
 # timestamp functions
 
@@ -37,22 +544,36 @@ def timestamp_to_unix(timestamp_string):
 
 # API credentials functions
 
+## one lock per credentials file so concurrent workers refresh a token once
+token_locks = {}
+token_locks_lock = threading.Lock()
+
+def token_lock(credentials_file):
+
+    with token_locks_lock:
+        return token_locks.setdefault(os.path.abspath(credentials_file), threading.Lock())
+
 def strava_token_exchange(credentials_file):
 
-    with open(credentials_file, 'r') as r:
-        api_credentials = json.load(r)
+    with token_lock(credentials_file):
+        with open(credentials_file, 'r') as r:
+            api_credentials = json.load(r)
+
+        # reusing the cached access token until it's close to expiring (Strava tokens last six hours)
+        if api_credentials.get('access_token') and api_credentials.get('expires_at', 0) - token_expiry_margin > time.time():
+            return api_credentials['access_token']
+
         client_id = api_credentials['client_id']
         client_secret = api_credentials['client_secret']
         refresh_token = api_credentials['refresh_token']
-        r.close()
 
-    req = requests.post("https://www.strava.com/oauth/token?client_id={}&client_secret={}&refresh_token={}&grant_type=refresh_token".format(client_id, client_secret, refresh_token)).json()
-    api_credentials['access_token'] = req['access_token']
-    api_credentials['refresh_token'] = req['refresh_token']
+        req = http_request('POST', "https://www.strava.com/oauth/token?client_id={}&client_secret={}&refresh_token={}&grant_type=refresh_token".format(client_id, client_secret, refresh_token)).json()
+        api_credentials['access_token'] = req['access_token']
+        api_credentials['refresh_token'] = req['refresh_token']
+        api_credentials['expires_at'] = req['expires_at']
 
-    with open(credentials_file, 'w') as w:
-        json.dump(api_credentials, w)
-        w.close()
+        # replacing the file atomically so a crash can't lose the (rotated) refresh token
+        atomic_write_json(api_credentials, credentials_file)
 
     access_token = api_credentials['access_token']
 
@@ -68,25 +589,44 @@ def geocode_key_getter(credentials_file):
 
 # Strava activities endpoint functions
 
-def request_activities(strava_access_token, start_date = False):
+def request_activities(strava_access_token, start_date = False, page = 1, per_page = max_per_page, end_date = False):
 
-    url = "https://www.strava.com/api/v3/" + "athlete/activities"
+    url = strava_base_url + "/" + "athlete/activities"
     headers = {"Authorization": "Bearer {}".format(strava_access_token)}
-    params = {}
+    params = {'page': page, 'per_page': per_page}
 
     if start_date:
         params['after'] = start_date
+    if end_date:
+        params['before'] = end_date
 
-    response = requests.get(url, headers = headers, params = params).json()
+    response = http_request('GET', url, headers = headers, params = params).json()
 
     return response
 
+def request_activity(strava_access_token, activity_id):
+
+    end_point = "activities/{}".format(activity_id)
+    url = strava_base_url + "/" + end_point
+    headers = {"Authorization": "Bearer {}".format(strava_access_token)}
+
+    response = http_request('GET', url, headers = headers)
+
+    # raising on error bodies (e.g. 401, 404, or a 5xx once retries run out) rather than returning them as an activity
+    response.raise_for_status()
+    activity = response.json()
+    if 'id' not in activity:
+        raise ValueError("unexpected response for activity {}: {}".format(activity_id, activity))
+
+    return activity
+
 def clean_activity(activity):
 
     clean_activity = {}
 
     clean_activity['id'] = activity['id']
     clean_activity['timestamp'] = sql_timestamp_formatter(activity['start_date_local'])
+    clean_activity['start_time'] = calendar.timegm(datetime.strptime(activity['start_date'], "%Y-%m-%dT%H:%M:%SZ").timetuple())
     clean_activity['activity_name'] = activity['name']
     clean_activity['activity_type'] = activity['type']
     clean_activity['distance'] = activity.get('distance', 0) / 1000
@@ -109,8 +649,8 @@ def clean_activity(activity):
 
 def request_location(geocode_key, latlng):
 
-    url = "https://maps.googleapis.com/maps/api/" + "geocode/json"
-    response = requests.get("{}?latlng={},{}&key={}".format(url, latlng[0], latlng[1], geocode_key)).json()
+    url = geocode_base_url + "/" + "geocode/json"
+    response = http_request('GET', "{}?latlng={},{}&key={}".format(url, latlng[0], latlng[1], geocode_key)).json()
 
     return response
 
@@ -124,45 +664,169 @@ def clean_location(location):
 
     return clean_location
 
-def get_run_type(activity):
+# geocode cache functions
+
+def load_geocode_cache(cache_file):
+
+    try:
+        with open(cache_file, 'r') as r:
+            cached_locations = json.load(r)
+    except FileNotFoundError:
+        cached_locations = []
+
+    # entries are stored least recently used first
+    entries = OrderedDict((tuple(entry['cell']), entry) for entry in cached_locations)
+
+    # guarding entries and counts when activities are engineered on several threads
+    return {'entries': entries, 'hits': 0, 'misses': 0, 'lock': threading.RLock()}
+
+def save_geocode_cache(geocode_cache, cache_file):
+
+    with geocode_cache['lock']:
+        cached_locations = list(geocode_cache['entries'].values())
+
+    # replacing the file in one rename, as the webhook, club and async runs may save it at the same time
+    atomic_write_json(cached_locations, cache_file)
+
+def geocode_cell(latlng):
+
+    return (math.floor(latlng[0] / geocode_cell_size), math.floor(latlng[1] / geocode_cell_size))
+
+def haversine_distance(latlng_a, latlng_b):
+
+    lat_a, lng_a, lat_b, lng_b = map(math.radians, [latlng_a[0], latlng_a[1], latlng_b[0], latlng_b[1]])
+    a = math.sin((lat_b - lat_a) / 2) ** 2 + math.cos(lat_a) * math.cos(lat_b) * math.sin((lng_b - lng_a) / 2) ** 2
+
+    return 2 * 6371000 * math.asin(math.sqrt(a))
+
+def nearest_cached_location(geocode_cache, latlng):
+
+    cell = geocode_cell(latlng)
+    # number of cells to search either side to cover the radius
+    lat_span = math.ceil(geocode_radius / (111320 * geocode_cell_size))
+    lng_span = math.ceil(lat_span / max(math.cos(math.radians(latlng[0])), 0.01))
+
+    nearest_entry = None
+    nearest_distance = geocode_radius
 
-    key_words_int = ['Intervals', 'Yasso', 'Track']
-    key_words_wu = ['WU', 'test']
+    for i in range(cell[0] - lat_span, cell[0] + lat_span + 1):
+        for j in range(cell[1] - lng_span, cell[1] + lng_span + 1):
+            entry = geocode_cache['entries'].get((i, j))
+            if entry:
+                distance = haversine_distance(latlng, entry['latlng'])
+                if distance <= nearest_distance:
+                    nearest_entry = entry
+                    nearest_distance = distance
 
-    for key_word in key_words_int:
-        if key_word in activity['activity_name']:
-            return 'I'
-    for key_word in key_words_wu:
-        if key_word in activity['activity_name']:
-            return 'WU'
-    if 'WD' in activity['activity_name']:
-            return 'WD'
+    return nearest_entry
 
-    elif activity['distance'] < 8:
+def cached_location(geocode_cache, geocode_key, latlng):
+
+    with geocode_cache['lock']:
+        entry = nearest_cached_location(geocode_cache, latlng)
+
+        if entry:
+            geocode_cache['hits'] += 1
+            count_metric('geocode_hits')
+            # marking entry as most recently used
+            geocode_cache['entries'].move_to_end(tuple(entry['cell']))
+            return entry['location']
+
+        geocode_cache['misses'] += 1
+        count_metric('geocode_misses')
+
+    location = clean_location(request_location(geocode_key, latlng))
+
+    with geocode_cache['lock']:
+        cell = geocode_cell(latlng)
+        geocode_cache['entries'][cell] = {'cell': list(cell), 'latlng': list(latlng), 'location': location}
+        geocode_cache['entries'].move_to_end(cell)
+
+        # evicting least recently used entries
+        while len(geocode_cache['entries']) > geocode_cache_size:
+            geocode_cache['entries'].popitem(last = False)
+
+    return location
+
+# activity name parsing
+
+## key words used to bin run types from activity names
+key_words_int = ['Intervals', 'Yasso', 'Track']
+key_words_wu = ['WU', 'test']
+key_words_wd = ['WD']
+
+## race results are written as "(MM:SS - 1st)" or "(H:MM:SS - 12th)"
+race_pattern = r'\((\d?:?\d{2}:\d{2})\s-\s(\d+)\w+\)'
+## last race result in a name (the leading .* is greedy)
+last_race_pattern = re.compile('.*' + race_pattern)
+
+## single pattern matching every key word in one scan of a name
+key_word_pattern = re.compile('|'.join([
+    '(?P<I>{})'.format('|'.join(key_words_int)),
+    '(?P<WU>{})'.format('|'.join(key_words_wu)),
+    '(?P<WD>{})'.format('|'.join(key_words_wd)),
+    '(?P<PR>PR)']))
+
+def distance_run_type(distance):
+
+    if distance < 8:
         return 'S'
-    elif activity['distance'] < 16:
+    elif distance < 16:
         return 'M'
     else:
-        return 'L'  
+        return 'L'
 
-def get_position(activity):
+def parse_activity_name(activity_name, distance, time):
 
-    pos_pattern = re.compile('.*\(\d?:?\d{2}:\d{2}\s-\s(\d+)\w+\)')
-    pos_pattern_match = re.findall(pos_pattern, activity['activity_name'])
+    # matching the race result on its own, so key words inside it (e.g. "(19:00 - 2ndPR)") are still found below
+    race_match = last_race_pattern.match(activity_name)
+    found = set(match.lastgroup for match in key_word_pattern.finditer(activity_name))
 
-    if pos_pattern_match:
-        return int(pos_pattern_match[0])
+    # key words take priority over distance bins in this order
+    run_type = next((key for key in ['I', 'WU', 'WD'] if key in found), None) or distance_run_type(distance)
+    position = int(race_match.group(2)) if race_match else 0
+    pr = 'PR' in found
+
+    if pr and run_type == 'S':
+        event_type = 'PR'
+    elif position > 0:
+        event_type = 'R'
     else:
-        return 0
+        event_type = 'W'
 
-def get_event_type(activity):
+    chip_time = HHMMSS_to_seconds(race_match.group(1)) if race_match else time
 
-    if ('PR' in activity['activity_name']) & (activity['run_type'] == 'S') :
-        return 'PR'
-    elif activity['position'] > 0:
-        return 'R'
-    else:
-        return 'W'
+    return {'run_type': run_type, 'position': position, 'pr': pr, 'event_type': event_type, 'chip_time': chip_time}
+
+def parse_activity_names(activity_names, distances, times):
+
+    activity_names = pd.Series(activity_names).astype(str)
+    distances = pd.Series(np.asarray(distances, dtype = 'float64'), index = activity_names.index)
+    times = pd.Series(np.asarray(times, dtype = 'int64'), index = activity_names.index)
+
+    # scanning all names at once for key words and the last race result
+    is_int = activity_names.str.contains('|'.join(key_words_int), regex = True)
+    is_wu = activity_names.str.contains('|'.join(key_words_wu), regex = True)
+    is_wd = activity_names.str.contains('|'.join(key_words_wd), regex = True)
+    is_pr = activity_names.str.contains('PR', regex = False)
+    race = activity_names.str.extract('.*' + race_pattern)
+
+    run_type = np.select(
+        [is_int, is_wu, is_wd, distances < 8, distances < 16],
+        ['I', 'WU', 'WD', 'S', 'M'],
+        default = 'L')
+    position = race[1].fillna(0).astype('int64')
+    event_type = np.select(
+        [is_pr & (run_type == 'S'), position > 0],
+        ['PR', 'R'],
+        default = 'W')
+
+    # converting [H:]MM:SS chip times to seconds
+    chip_time_parts = race[0].str.extract(r'(?:(\d+):)?(\d+):(\d+)$').astype('float64').fillna(0)
+    chip_time_seconds = (chip_time_parts[0] * 3600 + chip_time_parts[1] * 60 + chip_time_parts[2]).astype('int64')
+    chip_time = chip_time_seconds.where(race[0].notna(), times)
+
+    return pd.DataFrame({'run_type': run_type, 'position': position, 'pr': is_pr, 'event_type': event_type, 'chip_time': chip_time}, index = activity_names.index)
 
 def HHMMSS_to_seconds(time_HHMMSS):
 
@@ -173,32 +837,22 @@ def HHMMSS_to_seconds(time_HHMMSS):
 
     return time_seconds
 
-def get_chip_time(activity):
-
-    time_pattern = re.compile('.*\((\d?:?\d{2}:\d{2})\s-\s\d+\w+\)')
-    time_pattern_match = re.findall(time_pattern, activity['activity_name'])
-
-    if time_pattern_match:
-        return HHMMSS_to_seconds(time_pattern_match[0])
-    else:
-        return activity['time']
-
-def engineer_activity(activity, geocode_key):
+def engineer_activity(activity, geocode_key, geocode_cache = None):
 
     engineered_activity = activity.copy()
 
-    if activity['latlng']:
+    if activity['latlng'] and geocode_cache is not None:
+        engineered_activity['location'] = cached_location(geocode_cache, geocode_key, engineered_activity['latlng'])
+    elif activity['latlng']:
         engineered_activity['location'] = clean_location(request_location(geocode_key, engineered_activity['latlng']))
     else:
         engineered_activity['location'] = 'missing'
-    ## binning activities based on distances
-    engineered_activity['run_type'] = get_run_type(engineered_activity)
-    ## extracting race positions from activity names
-    engineered_activity['position'] = get_position(engineered_activity)
-    ## extracting event types from activity names
-    engineered_activity['event_type'] = get_event_type(engineered_activity)
-    ## extracting race chip times from activity names
-    engineered_activity['chip_time'] = get_chip_time(engineered_activity)
+    ## extracting run types, race positions, event types and chip times from activity names in one pass
+    parsed_name = parse_activity_name(engineered_activity['activity_name'], engineered_activity['distance'], engineered_activity['time'])
+    engineered_activity['run_type'] = parsed_name['run_type']
+    engineered_activity['position'] = parsed_name['position']
+    engineered_activity['event_type'] = parsed_name['event_type']
+    engineered_activity['chip_time'] = parsed_name['chip_time']
 
     # dropping redundant features
     engineered_activity.pop('latlng', None)
@@ -206,37 +860,180 @@ def engineer_activity(activity, geocode_key):
     
     return engineered_activity
 
-def processed_activities(strava_access_token, geocode_key, start_date = False):
+def paginated_activities(strava_access_token, start_date = False, per_page = max_per_page, end_date = False):
 
-    processed_activities = []
+    page = 1
 
-    activities_response = request_activities(strava_access_token, start_date)
-    if activities_response:
-        clean_activities = [clean_activity(activity) for activity in activities_response]
-        engineered_activities = [engineer_activity(activity, geocode_key) for activity in clean_activities]
+    # walking pages until Strava returns a short (or empty) page
+    while True:
+        activities_response = request_activities(strava_access_token, start_date, page, per_page, end_date)
+        yield from activities_response
 
-        for activity in engineered_activities:
-            if activity['activity_type'] == 'Run':
-                activity.pop('activity_type', None)
-                processed_activities.append(activity)
-            else:
-                continue
+        if len(activities_response) < per_page:
+            return
+        page += 1
+
+def paginated_runs(strava_access_token, start_date = False, per_page = max_per_page, end_date = False):
+
+    # skipping non-runs before cleaning to avoid needless geocoding requests
+    return (activity for activity in paginated_activities(strava_access_token, start_date, per_page, end_date) if activity['type'] == 'Run')
+
+def date_windows(start_date, end_date, window_days):
+
+    windows = []
+    after = start_date
+
+    while after < end_date:
+        before = min(after + window_days * 24 * 60 * 60, end_date)
+        # overlapping windows by a second so activities on a boundary aren't missed (duplicates are dropped when merging)
+        windows.append([after - 1, before])
+        after = before
+
+    return windows
+
+def engineered_activities(activities, geocode_key, geocode_cache = None):
+
+    for activity in activities:
+        engineered_activity = engineer_activity(clean_activity(activity), geocode_key, geocode_cache)
+        engineered_activity.pop('activity_type', None)
+
+        yield engineered_activity
+
+def stream_activities(strava_access_token, geocode_key, start_date = False, per_page = max_per_page, geocode_cache = None):
+
+    return engineered_activities(paginated_runs(strava_access_token, start_date, per_page), geocode_key, geocode_cache)
+
+def processed_activities(strava_access_token, geocode_key, start_date = False, geocode_cache = None):
+
+    processed_activities = list(stream_activities(strava_access_token, geocode_key, start_date, geocode_cache = geocode_cache))
     
     return processed_activities
+
+def batched(iterable, batch_size):
+
+    iterator = iter(iterable)
+
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
     
 
+# known activity index functions
+
+def mixed_hash(values):
+
+    # splitmix64 finaliser, spreading sequential ids evenly over the bits
+    values = values ^ (values >> np.uint64(30))
+    values = values * np.uint64(0xBF58476D1CE4E5B9)
+    values = values ^ (values >> np.uint64(27))
+    values = values * np.uint64(0x94D049BB133111EB)
+    return values ^ (values >> np.uint64(31))
+
+def bloom_positions(activity_ids, n_bits, n_hashes):
+
+    # double hashing each id into n_hashes bit positions
+    activity_ids = np.asarray(activity_ids, dtype = 'uint64')
+    h1 = mixed_hash(activity_ids)
+    h2 = mixed_hash(activity_ids + np.uint64(0x9E3779B97F4A7C15)) | np.uint64(1)
+    positions = [(h1 + np.uint64(i) * h2) % np.uint64(n_bits) for i in range(n_hashes)]
+
+    return np.stack(positions, axis = 1)
+
+def load_activity_index(conn, bloom_threshold = None):
+
+    with conn.cursor() as cur:
+        cur.execute("""SELECT count(*) FROM activities;""")
+        n = cur.fetchone()[0]
+
+    activity_index = {'ids': None, 'bloom': None, 'n_hashes': 0, 'conn': conn, 'size': n, 'requests_avoided': 0, 'lock': threading.RLock()}
+
+    # streaming ids with a server side cursor so large histories aren't held twice
+    with conn.cursor(name = 'activity_index') as cur:
+        cur.itersize = 100000
+        cur.execute("""SELECT id FROM activities;""")
+
+        if n <= (bloom_threshold or activity_index_bloom_threshold):
+            activity_index['ids'] = set(row[0] for row in cur)
+        else:
+            # sizing the filter for the target false positive rate
+            n_bits = int(math.ceil(-n * math.log(activity_index_false_positive_rate) / math.log(2) ** 2))
+            activity_index['n_hashes'] = max(1, int(round(n_bits / n * math.log(2))))
+            activity_index['bloom'] = np.zeros(n_bits, dtype = bool)
+            for rows in iter(lambda: cur.fetchmany(cur.itersize), []):
+                add_to_activity_index(activity_index, [row[0] for row in rows])
+
+    conn.commit()
+
+    return activity_index
+
+def add_to_activity_index(activity_index, activity_ids):
+
+    if not activity_ids:
+        return
+
+    with activity_index['lock']:
+        if activity_index['ids'] is not None:
+            activity_index['ids'].update(activity_ids)
+        else:
+            bloom = activity_index['bloom']
+            bloom[bloom_positions(activity_ids, len(bloom), activity_index['n_hashes']).ravel()] = True
+
+def new_activity_ids(activity_index, activity_ids):
+
+    if activity_index is None:
+        return list(activity_ids)
+
+    with activity_index['lock']:
+        if activity_index['ids'] is not None:
+            return [activity_id for activity_id in activity_ids if activity_id not in activity_index['ids']]
+
+        if not activity_ids:
+            return []
+
+        # checking the filter, then confirming possible matches so a false positive never skips a new activity
+        bloom = activity_index['bloom']
+        maybe_loaded = bloom[bloom_positions(activity_ids, len(bloom), activity_index['n_hashes'])].all(axis = 1)
+        candidates = [activity_id for activity_id, loaded in zip(activity_ids, maybe_loaded) if loaded]
+
+        loaded_ids = set()
+        if candidates:
+            with activity_index['conn'].cursor() as cur:
+                cur.execute("""SELECT id FROM activities WHERE id = ANY(%s);""", (candidates,))
+                loaded_ids = set(row[0] for row in cur.fetchall())
+
+    return [activity_id for activity_id in activity_ids if activity_id not in loaded_ids]
+
+def skip_known_activities(activity_index, activity_ids, requests_per_activity = 1):
+
+    # dropping activities already in the database and counting the requests saved
+    remaining_ids = new_activity_ids(activity_index, activity_ids)
+
+    if activity_index is not None:
+        with activity_index['lock']:
+            activity_index['requests_avoided'] += (len(activity_ids) - len(remaining_ids)) * requests_per_activity
+        count_metric('requests_avoided', (len(activity_ids) - len(remaining_ids)) * requests_per_activity)
+
+    return remaining_ids
+
 # Strava splits endpoint functions
 
 def request_splits(strava_access_token, activity_id):
 
-    base_url = "https://www.strava.com/api/v3"
     end_point = "activities/{}/laps".format(activity_id)
-    url = base_url + "/" + end_point
+    url = strava_base_url + "/" + end_point
     headers = {"Authorization": "Bearer {}".format(strava_access_token)}
 
-    response = requests.get(url, headers = headers).json()
+    response = http_request('GET', url, headers = headers)
 
-    return response
+    # skipping activities deleted since they were listed, and raising on other error bodies (e.g. a 5xx once retries run out) rather than returning them as laps
+    if response.status_code == 404:
+        print("laps for activity {} not fetched (404)".format(activity_id))
+        return None
+    response.raise_for_status()
+
+    return response.json()
 
 def clean_splits(activity_splits, activity_id):
     
@@ -259,14 +1056,20 @@ def clean_splits(activity_splits, activity_id):
     
     return cleaned_splits
 
-def processed_splits(strava_access_token, activity_ids):
+def processed_splits(strava_access_token, activity_ids, max_workers = None, activity_index = None):
 
     processed_splits = []
+    activity_ids = skip_known_activities(activity_index, activity_ids)
+
+    # executor.map yields responses in the same order as activity_ids
+    with ThreadPoolExecutor(max_workers = max_workers or max_concurrent_requests) as executor:
+        splits_responses = executor.map(lambda activity_id: request_splits(strava_access_token, activity_id), activity_ids)
 
-    for activity_id in activity_ids:
-        splits_response = request_splits(strava_access_token, activity_id)
-        cleaned_splits = clean_splits(splits_response, activity_id)
-        processed_splits += cleaned_splits
+        for activity_id, splits_response in zip(activity_ids, splits_responses):
+            if splits_response is None:
+                continue
+            cleaned_splits = clean_splits(splits_response, activity_id)
+            processed_splits += cleaned_splits
     
     return processed_splits
 
@@ -274,14 +1077,19 @@ def processed_splits(strava_access_token, activity_ids):
 
 def request_zones(strava_access_token, activity_id):
 
-    base_url = "https://www.strava.com/api/v3"
     end_point = "activities/{}/zones".format(activity_id)
-    url = base_url + "/" + end_point
+    url = strava_base_url + "/" + end_point
     headers = {"Authorization": "Bearer {}".format(strava_access_token)}
 
-    response = requests.get(url, headers = headers).json()
+    response = http_request('GET', url, headers = headers)
 
-    return response
+    # skipping activities deleted since they were listed, and raising on other error bodies (e.g. a 5xx once retries run out) rather than returning them as zones
+    if response.status_code == 404:
+        print("zones for activity {} not fetched (404)".format(activity_id))
+        return None
+    response.raise_for_status()
+
+    return response.json()
 
 def clean_zones(activity_zones, activity_id):
 
@@ -303,17 +1111,348 @@ def clean_zones(activity_zones, activity_id):
 
     return cleaned_zones
 
-def processed_zones(strava_access_token, activity_ids):
+def processed_zones(strava_access_token, activity_ids, max_workers = None, activity_index = None):
 
     processed_zones = []
+    activity_ids = skip_known_activities(activity_index, activity_ids)
+
+    # executor.map yields responses in the same order as activity_ids
+    with ThreadPoolExecutor(max_workers = max_workers or max_concurrent_requests) as executor:
+        zones_responses = executor.map(lambda activity_id: request_zones(strava_access_token, activity_id), activity_ids)
 
-    for activity_id in activity_ids:
-        zones_response = request_zones(strava_access_token, activity_id)
-        cleaned_zones = clean_zones(zones_response, activity_id)
-        processed_zones += cleaned_zones
+        for activity_id, zones_response in zip(activity_ids, zones_responses):
+            if zones_response is None:
+                continue
+            cleaned_zones = clean_zones(zones_response, activity_id)
+            processed_zones += cleaned_zones
     
     return processed_zones
 
+# Strava laps and zones endpoint functions
+
+def requested_splits_and_zones(strava_access_token, activity_ids, max_workers = None):
+
+    with ThreadPoolExecutor(max_workers = max_workers or max_concurrent_requests) as executor:
+        # submitting laps and zones requests for each activity side by side
+        futures = [(activity_id, executor.submit(request_splits, strava_access_token, activity_id), executor.submit(request_zones, strava_access_token, activity_id)) for activity_id in activity_ids]
+
+        # yielding responses in the same order as activity_ids, leaving out activities deleted since they were listed
+        for activity_id, splits_future, zones_future in futures:
+            splits_response, zones_response = splits_future.result(), zones_future.result()
+            if splits_response is not None and zones_response is not None:
+                yield activity_id, splits_response, zones_response
+
+def processed_splits_and_zones(strava_access_token, activity_ids, max_workers = None, activity_index = None):
+
+    processed_splits = []
+    processed_zones = []
+    activity_ids = skip_known_activities(activity_index, activity_ids, requests_per_activity = 2)
+
+    for activity_id, splits_response, zones_response in requested_splits_and_zones(strava_access_token, activity_ids, max_workers):
+        processed_splits += clean_splits(splits_response, activity_id)
+        processed_zones += clean_zones(zones_response, activity_id)
+
+    return processed_splits, processed_zones
+
+# Strava streams endpoint functions
+
+def request_streams(strava_access_token, activity_id):
+
+    end_point = "activities/{}/streams".format(activity_id)
+    url = strava_base_url + "/" + end_point
+    headers = {"Authorization": "Bearer {}".format(strava_access_token)}
+    params = {'keys': ','.join(stream_dtypes), 'key_by_type': 'true'}
+
+    response = http_request('GET', url, headers = headers, params = params)
+
+    # skipping error bodies (e.g. a 404 or a 5xx once retries run out), so the streams are requested again next run
+    if not response.ok:
+        print("streams for activity {} not fetched ({})".format(activity_id, response.status_code))
+        return None
+
+    return response.json()
+
+def clean_streams(activity_streams):
+
+    # packing each stream into a typed array, skipping streams the activity didn't record
+    cleaned_streams = {}
+
+    for key, dtype in stream_dtypes.items():
+        if key in activity_streams:
+            cleaned_streams[key] = np.asarray(activity_streams[key]['data'], dtype = dtype)
+
+    return cleaned_streams
+
+def activity_streams_dir(activity_id):
+
+    return os.path.join(streams_dir, str(activity_id))
+
+def save_streams(activity_id, activity_streams):
+
+    activity_dir = activity_streams_dir(activity_id)
+
+    # writing every array into a temporary directory then renaming it, so a crash never leaves streams that look stored
+    temp_dir = "{}.{}.tmp".format(activity_dir, os.getpid())
+    shutil.rmtree(temp_dir, ignore_errors = True)
+    os.makedirs(temp_dir)
+
+    for key, values in activity_streams.items():
+        np.save(os.path.join(temp_dir, "{}.npy".format(key)), values)
+
+    shutil.rmtree(activity_dir, ignore_errors = True)
+    os.replace(temp_dir, activity_dir)
+
+def load_streams(activity_id, keys = None):
+
+    activity_dir = activity_streams_dir(activity_id)
+    loaded_streams = {}
+
+    for key in keys or stream_dtypes:
+        file_name = os.path.join(activity_dir, "{}.npy".format(key))
+        if os.path.exists(file_name):
+            # memory mapping the file so no data is copied until it's read
+            loaded_streams[key] = np.load(file_name, mmap_mode = 'r')
+
+    return loaded_streams
+
+def stored_stream_ids():
+
+    if not os.path.isdir(streams_dir):
+        return set()
+
+    # counting only renamed directories (temporary ones are named <id>.<pid>.tmp)
+    return set(int(activity_id) for activity_id in os.listdir(streams_dir) if activity_id.isdigit())
+
+def processed_streams(strava_access_token, activity_ids, max_workers = None):
+
+    # skipping activities whose streams are already stored
+    stored_ids = stored_stream_ids()
+    remaining_ids = [activity_id for activity_id in activity_ids if activity_id not in stored_ids]
+
+    with ThreadPoolExecutor(max_workers = max_workers or max_concurrent_requests) as executor:
+        streams_responses = executor.map(lambda activity_id: request_streams(strava_access_token, activity_id), remaining_ids)
+
+        n = 0
+        for activity_id, streams_response in zip(remaining_ids, streams_responses):
+            activity_streams = clean_streams(streams_response) if streams_response else {}
+
+            # leaving activities without streams (failed requests, manual activities) unstored, to be requested again
+            if activity_streams:
+                save_streams(activity_id, activity_streams)
+                n += 1
+
+    return n
+
+def best_effort(activity_streams, effort_distance):
+
+    elapsed = activity_streams['time']
+    distance = activity_streams['distance']
+
+    # finding, for every start point, the first point at least effort_distance further on
+    ends = np.searchsorted(distance, distance + effort_distance)
+    valid = ends < len(distance)
+    if not valid.any():
+        return None
+
+    return int((elapsed[ends[valid]] - elapsed[valid]).min())
+
+# batch (columnar) cleaning functions
+
+def record_column(records, key, default = 0, dtype = 'float64'):
+
+    # mirroring record.get(key, default) for a whole batch of records
+    if dtype == object:
+        return pd.Series([record.get(key, default) for record in records], dtype = object)
+
+    return np.fromiter((record.get(key) or default for record in records), dtype = dtype, count = len(records))
+
+def clean_activities_frame(activities):
+
+    activities = list(activities)
+    start_dates = pd.Series([activity['start_date_local'] for activity in activities], dtype = object)
+
+    clean_activities = pd.DataFrame({
+        'id': record_column(activities, 'id', dtype = 'int64'),
+        # converting ISO-8601 strings to PostgreSQL timestamps
+        'timestamp': start_dates.str.slice(0, 10) + ' ' + start_dates.str.slice(11, 19),
+        'start_time': (pd.to_datetime(pd.Series([activity['start_date'] for activity in activities], dtype = object), utc = True) - pd.Timestamp(0, tz = 'UTC')) // pd.Timedelta(seconds = 1),
+        'activity_name': record_column(activities, 'name', dtype = object),
+        'activity_type': record_column(activities, 'type', dtype = object),
+        'distance': record_column(activities, 'distance') / 1000,
+        'time': record_column(activities, 'elapsed_time', dtype = 'int64'),
+        'latlng': record_column(activities, 'start_latlng', [], dtype = object),
+        'elevation_gain': record_column(activities, 'total_elevation_gain'),
+        'average_speed': record_column(activities, 'average_speed') * 3.6,
+        'max_speed': record_column(activities, 'max_speed') * 3.6,
+        'average_hr': record_column(activities, 'average_heartrate'),
+        'max_hr': record_column(activities, 'max_heartrate'),
+        'average_cadence': record_column(activities, 'average_cadence'),
+        'kudos': record_column(activities, 'kudos_count', dtype = 'int64'),
+        'suffer_score': record_column(activities, 'suffer_score', dtype = 'int64')})
+
+    return clean_activities
+
+def clean_splits_frame(splits_by_activity):
+
+    # splits_by_activity is a sequence of (activity_id, laps response) pairs
+    activity_ids = np.fromiter((activity_id for activity_id, splits in splits_by_activity), dtype = 'int64', count = len(splits_by_activity))
+    n_splits = np.fromiter((len(splits) for activity_id, splits in splits_by_activity), dtype = 'int64', count = len(splits_by_activity))
+    splits = [split for activity_id, activity_splits in splits_by_activity for split in activity_splits]
+
+    clean_splits = pd.DataFrame({
+        'activity_id': np.repeat(activity_ids, n_splits),
+        'split_index': record_column(splits, 'split', dtype = 'int64'),
+        'distance': record_column(splits, 'distance') / 1000,
+        'time': record_column(splits, 'elapsed_time', dtype = 'int64'),
+        'elevation_gain': record_column(splits, 'total_elevation_gain'),
+        'average_speed': record_column(splits, 'average_speed') * 3.6,
+        'max_speed': record_column(splits, 'max_speed') * 3.6,
+        'average_hr': record_column(splits, 'average_heartrate'),
+        'max_hr': record_column(splits, 'max_heartrate'),
+        'average_cadence': record_column(splits, 'average_cadence')})
+
+    return clean_splits
+
+def clean_zones_frame(zones_by_activity):
+
+    # zones_by_activity is a sequence of (activity_id, zones response) pairs
+    distributions = [(activity_id, distribution['type'], distribution['distribution_buckets']) for activity_id, activity_zones in zones_by_activity for distribution in activity_zones]
+    n_buckets = np.fromiter((len(buckets) for activity_id, zone_type, buckets in distributions), dtype = 'int64', count = len(distributions))
+    buckets = [bucket for activity_id, zone_type, zone_buckets in distributions for bucket in zone_buckets]
+
+    # reshaping wide bucket lists to one row per zone
+    bucket_starts = np.repeat(np.cumsum(n_buckets) - n_buckets, n_buckets)
+    clean_zones = pd.DataFrame({
+        'activity_id': np.repeat(np.fromiter((distribution[0] for distribution in distributions), dtype = 'int64', count = len(distributions)), n_buckets),
+        'zone_type': np.repeat(np.array([distribution[1] for distribution in distributions], dtype = object), n_buckets),
+        'zone_index': np.arange(len(buckets)) - bucket_starts + 1,
+        'time': record_column(buckets, 'time', dtype = 'int64')})
+
+    return clean_zones
+
+def frame_records(frame):
+
+    return frame.to_dict('records')
+
+# checkpoint functions
+
+def truncate_partial_line(file_name):
+
+    # dropping a record cut short by an interrupted write, so an append never joins its first record onto the fragment
+    try:
+        with open(file_name, 'rb+') as rw:
+            size = rw.seek(0, os.SEEK_END)
+            position = size
+            end = 0
+            while position > 0:
+                step = min(4096, position)
+                position -= step
+                rw.seek(position)
+                newline = rw.read(step).rfind(b'\n')
+                if newline != -1:
+                    end = position + newline + 1
+                    break
+            if end < size:
+                rw.truncate(end)
+    except FileNotFoundError:
+        return
+
+def write_jsonl(records, file_name, mode = 'w'):
+
+    n = 0
+
+    if mode == 'a':
+        truncate_partial_line(file_name)
+
+    with open(file_name, mode) as w:
+        for record in records:
+            w.write(json.dumps(record, separators = (',', ':')) + '\n')
+            # flushing each record so an interrupted stage keeps what it fetched
+            w.flush()
+            n += 1
+
+    return n
+
+def read_jsonl(file_name):
+
+    try:
+        with open(file_name, 'r') as r:
+            for line in r:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    # skipping a record cut short by an interrupted write
+                    continue
+    except FileNotFoundError:
+        return
+
+def jsonl_offsets(file_name, key):
+
+    offsets = {}
+
+    # indexing where each record starts by one of its fields, so records can be read back without holding the file in memory
+    try:
+        with open(file_name, 'rb') as r:
+            while True:
+                offset = r.tell()
+                line = r.readline()
+                if not line:
+                    break
+                try:
+                    offsets.setdefault(json.loads(line)[key], offset)
+                except json.JSONDecodeError:
+                    # skipping a record cut short by an interrupted write
+                    continue
+    except FileNotFoundError:
+        pass
+
+    return offsets
+
+def read_jsonl_at(file_name, offsets):
+
+    with open(file_name, 'rb') as r:
+        for offset in offsets:
+            r.seek(offset)
+            yield json.loads(r.readline())
+
+def new_run_dir(runs_dir):
+
+    run_dir = os.path.join(runs_dir, datetime.now().strftime('%Y%m%d%H%M%S%f'))
+    os.makedirs(run_dir)
+
+    return run_dir
+
+def unfinished_run_dir(runs_dir):
+
+    # run ids are timestamps so the newest run sorts last
+    run_ids = sorted(os.listdir(runs_dir)) if os.path.isdir(runs_dir) else []
+
+    # only the newest run is resumed, older ones were covered by a later run
+    if run_ids and 'load' not in read_stages(os.path.join(runs_dir, run_ids[-1])):
+        return os.path.join(runs_dir, run_ids[-1])
+
+    return None
+
+def read_stages(run_dir):
+
+    try:
+        with open(os.path.join(run_dir, 'stages.json'), 'r') as r:
+            stages = json.load(r)
+    except FileNotFoundError:
+        stages = {}
+
+    return stages
+
+## stages of a run can complete on several threads (e.g. backfill shards)
+stages_lock = threading.Lock()
+
+def complete_stage(run_dir, stage, **details):
+
+    with stages_lock:
+        stages = read_stages(run_dir)
+        stages[stage] = dict(details, completed_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+        atomic_write_json(stages, os.path.join(run_dir, 'stages.json'))
+
 # appending requests to csv file
 
 def append_requests(requests, file_name):
@@ -337,7 +1476,6 @@ def commit(conn, sql_statement):
     cur.execute(sql_statement)
     conn.commit()
     cur.close()
-    return print("statement committed")
 
 def fetch(conn, sql_statement):
     cur = conn.cursor()
@@ -350,4 +1488,298 @@ def insert_statement(table_name, record):
     columns = ', '.join(list(record.keys()))
     values = str(tuple(record.values()))
     statement = """INSERT INTO {} ({}) VALUES {};""".format(table_name, columns, values)
-    return statement
\ No newline at end of file
+    return statement
+
+# bulk loading records
+
+def bulk_insert(cur, table_name, records, conflict_columns = None, page_size = 1000):
+    columns = list(records[0].keys())
+    statement = """INSERT INTO {} ({}) VALUES %s""".format(table_name, ', '.join(columns))
+
+    # updating existing rows instead of failing on duplicate keys
+    if conflict_columns:
+        updates = ', '.join(['{0} = EXCLUDED.{0}'.format(column) for column in columns if column not in conflict_columns])
+        statement += """ ON CONFLICT ({}) DO UPDATE SET {}""".format(', '.join(conflict_columns), updates)
+
+    values = [tuple(record[column] for column in columns) for record in records]
+    execute_values(cur, statement, values, page_size = page_size)
+
+def bulk_load(conn, activities, splits, zones, activity_index = None):
+    activity_ids = [activity['id'] for activity in activities]
+    # keeping laps and zones of activities already in the index unless they were fetched again
+    hydrated_ids = set(new_activity_ids(activity_index, activity_ids))
+    hydrated_ids.update(row['activity_id'] for row in splits + zones)
+    hydrated_ids = list(hydrated_ids)
+
+    # loading all three tables in a single transaction
+    with conn.cursor() as cur:
+        if activities:
+            # keeping the UTC start time (only used for watermarks) out of the activities table
+            bulk_insert(cur, "activities", [{key: value for key, value in activity.items() if key != 'start_time'} for activity in activities], conflict_columns = ['id'])
+
+        # replacing laps and zones for each hydrated activity so re-runs are idempotent
+        cur.execute("""DELETE FROM activity_zones WHERE activity_id = ANY(%s);""", (hydrated_ids,))
+        cur.execute("""DELETE FROM activity_splits WHERE activity_id = ANY(%s);""", (hydrated_ids,))
+
+        if zones:
+            bulk_insert(cur, "activity_zones", zones)
+        if splits:
+            bulk_insert(cur, "activity_splits", splits)
+
+    # updating the weeks of the loaded activities in the weekly rollups, in the same transaction
+    if activities:
+        refresh_rollups(conn, [activity['timestamp'] for activity in activities])
+
+    changed_tables = [table_name for table_name, records in [('activities', activities), ('activity_zones', hydrated_ids), ('activity_splits', hydrated_ids)] if records]
+    notify_data_changed(conn, changed_tables + (rollup_tables if activities else []))
+
+    conn.commit()
+
+    if activity_index is not None:
+        add_to_activity_index(activity_index, activity_ids)
+
+    rows_loaded = {'activities': len(activities), 'activity_zones': len(zones), 'activity_splits': len(splits)}
+    record_rows(rows_loaded)
+
+    return rows_loaded
+
+def delete_activities(conn, activity_ids):
+
+    # removing activities along with their laps and zones in one transaction
+    with conn.cursor() as cur:
+        cur.execute("""DELETE FROM activity_zones WHERE activity_id = ANY(%s);""", (activity_ids,))
+        cur.execute("""DELETE FROM activity_splits WHERE activity_id = ANY(%s);""", (activity_ids,))
+        cur.execute("""DELETE FROM activities WHERE id = ANY(%s) RETURNING timestamp;""", (activity_ids,))
+        timestamps = [row[0] for row in cur.fetchall()]
+
+    # updating the weeks of the removed activities in the weekly rollups
+    if timestamps:
+        refresh_rollups(conn, timestamps)
+        notify_data_changed(conn, ['activities', 'activity_zones', 'activity_splits'] + rollup_tables)
+
+    conn.commit()
+
+    return len(timestamps)
+
+# weekly rollup functions
+
+def moving_average_weights(n_weeks = None):
+
+    n_weeks = n_weeks or rollup_weeks
+
+    # weighting the previous weeks (1 = last week) for simple, linearly and exponentially weighted moving averages
+    exp_factor = np.exp(2 / (n_weeks + 1))
+    norm_constant = sum([exp_factor ** -i for i in range(1, n_weeks + 1)])
+    weights = [(i, 1 / n_weeks, (n_weeks + 1 - i) / (n_weeks * (n_weeks + 1) / 2), exp_factor ** -i / norm_constant) for i in range(1, n_weeks + 1)]
+
+    return weights
+
+def weighted_lags(column, weights, weight_index):
+
+    # summing lagged values with window functions rather than joining each week to the weeks before it
+    return ' + '.join(["{} * coalesce(LAG({}, {}) OVER w, 0)".format(repr(float(weight[weight_index])), column, weight[0]) for weight in weights])
+
+def changed_weeks(cur, table_name, timestamps):
+
+    # weeks holding changed activities, plus weeks of the history not yet in the table (all of them on a rebuild)
+    cur.execute("""
+SELECT date_trunc('week', changed) AS week
+FROM unnest(%(timestamps)s::timestamp[]) changed
+UNION
+SELECT week
+FROM generate_series(
+    (SELECT date_trunc('week', MIN(timestamp)) FROM activities),
+    (SELECT date_trunc('week', MAX(timestamp)) FROM activities),
+    '7 day'::interval) week
+WHERE week NOT IN (SELECT week FROM {})
+ORDER BY 1;""".format(table_name), {'timestamps': timestamps})
+
+    return [row[0] for row in cur.fetchall() if row[0] is not None]
+
+def trim_weeks(cur, table_name):
+
+    # dropping weeks outside the history (e.g. after the latest activity was deleted)
+    cur.execute("""
+DELETE FROM {}
+WHERE NOT EXISTS (SELECT 1 FROM activities)
+    OR week > (SELECT date_trunc('week', MAX(timestamp)) FROM activities)
+    OR week < (SELECT date_trunc('week', MIN(timestamp)) FROM activities);""".format(table_name))
+
+def refresh_weekly_distance(conn, timestamps = None):
+
+    weights = moving_average_weights()
+
+    with conn.cursor() as cur:
+        # rebuilding every week when no changes are given
+        if timestamps is None:
+            cur.execute("""TRUNCATE weekly_distance;""")
+
+        weeks = changed_weeks(cur, 'weekly_distance', timestamps or [])
+
+        # re-totalling only the changed weeks from the activities table
+        cur.execute("""
+INSERT INTO weekly_distance (week, total_distance)
+SELECT
+    c.week,
+    coalesce(SUM(a.distance), 0) AS total_distance
+FROM unnest(%(weeks)s::timestamp[]) c(week)
+LEFT JOIN activities a
+ON a.timestamp >= c.week AND a.timestamp < c.week + '7 day'::interval
+GROUP BY 1
+ON CONFLICT (week) DO UPDATE SET total_distance = EXCLUDED.total_distance;""", {'weeks': weeks})
+
+        trim_weeks(cur, 'weekly_distance')
+
+        # recomputing moving stats for the weeks whose windows cover a changed week, reading the rollup rather than activities
+        # (counting a changed week before the start of the history as the first week, as the weeks after it lose rows from their windows)
+        cur.execute("""
+WITH moving_averages AS(
+SELECT
+    week,
+    STDDEV(total_distance) OVER(ORDER BY week ROWS BETWEEN {n} PRECEDING AND 1 PRECEDING) AS moving_std,
+    {simple} AS simple_moving_avg,
+    {linear} AS linear_moving_avg,
+    {exp} AS exp_moving_avg
+FROM weekly_distance
+WHERE week >= (SELECT MIN(week) FROM unnest(%(weeks)s::timestamp[]) week) - interval '{n} weeks'
+WINDOW w AS (ORDER BY week))
+UPDATE weekly_distance d
+SET
+    moving_std = m.moving_std,
+    simple_moving_avg = m.simple_moving_avg,
+    linear_moving_avg = m.linear_moving_avg,
+    exp_moving_avg = m.exp_moving_avg
+FROM moving_averages m
+WHERE d.week = m.week
+    AND d.week > (SELECT MIN(week) FROM weekly_distance)
+    AND EXISTS (SELECT 1 FROM unnest(%(weeks)s::timestamp[]) changed WHERE d.week BETWEEN changed AND GREATEST(changed, (SELECT MIN(week) FROM weekly_distance)) + interval '{n} weeks');""".format(
+            n = len(weights),
+            simple = weighted_lags('total_distance', weights, 1),
+            linear = weighted_lags('total_distance', weights, 2),
+            exp = weighted_lags('total_distance', weights, 3)), {'weeks': weeks})
+
+        # leaving the first week without averages, as it has no weeks before it
+        cur.execute("""
+UPDATE weekly_distance
+SET moving_std = NULL, simple_moving_avg = NULL, linear_moving_avg = NULL, exp_moving_avg = NULL
+WHERE week = (SELECT MIN(week) FROM weekly_distance);""")
+
+    return len(weeks)
+
+def refresh_weekly_zone_time(conn, timestamps = None):
+
+    n = rollup_weeks
+
+    with conn.cursor() as cur:
+        # rebuilding every week when no changes are given
+        if timestamps is None:
+            cur.execute("""TRUNCATE weekly_zone_time;""")
+
+        weeks = changed_weeks(cur, 'weekly_zone_time', timestamps or [])
+
+        # re-totalling heart rate zone time for the changed weeks only
+        cur.execute("""
+INSERT INTO weekly_zone_time (week, zone, time)
+SELECT
+    c.week,
+    z.zone,
+    coalesce(SUM(b.time), 0) AS time
+FROM unnest(%(weeks)s::timestamp[]) c(week)
+CROSS JOIN generate_series(1, 5) z(zone)
+LEFT JOIN activities a
+ON a.timestamp >= c.week AND a.timestamp < c.week + '7 day'::interval
+LEFT JOIN activity_zones b
+ON b.activity_id = a.id AND b.zone_type = 'heartrate' AND b.zone_index = z.zone
+GROUP BY 1, 2
+ON CONFLICT (week, zone) DO UPDATE SET time = EXCLUDED.time;""", {'weeks': weeks})
+
+        trim_weeks(cur, 'weekly_zone_time')
+
+        # recomputing 6-week zone shares with window frames for the weeks whose windows cover a changed week, plus
+        # the week after, which loses its NULL share when a load moves the start of the history back
+        cur.execute("""
+WITH recent AS(
+SELECT week, zone, time
+FROM weekly_zone_time
+WHERE week >= (SELECT MIN(week) FROM unnest(%(weeks)s::timestamp[]) week) - interval '{n} weeks'),
+moving_zones AS(
+SELECT
+    week,
+    zone,
+    SUM(time) OVER(PARTITION BY zone ORDER BY week ROWS BETWEEN {preceding} PRECEDING AND CURRENT ROW) AS moving_time
+FROM recent),
+moving_totals AS(
+SELECT
+    week,
+    SUM(SUM(time)) OVER(ORDER BY week ROWS BETWEEN {preceding} PRECEDING AND CURRENT ROW) AS moving_total
+FROM recent
+GROUP BY 1)
+UPDATE weekly_zone_time t
+SET
+    moving_time = z.moving_time,
+    moving_total = m.moving_total,
+    moving_percentage = z.moving_time / NULLIF(m.moving_total, 0) * 100
+FROM moving_zones z
+JOIN moving_totals m
+ON z.week = m.week
+WHERE t.week = z.week AND t.zone = z.zone
+    AND EXISTS (SELECT 1 FROM unnest(%(weeks)s::timestamp[]) changed WHERE t.week BETWEEN changed AND changed + interval '{n} weeks');""".format(n = n, preceding = n - 1), {'weeks': weeks})
+
+        # leaving shares empty until a full window of weeks is available
+        cur.execute("""
+UPDATE weekly_zone_time
+SET moving_percentage = NULL
+WHERE week < (SELECT MIN(week) FROM weekly_zone_time) + interval '{} weeks';""".format(n))
+
+    return len(weeks)
+
+## rollup tables refresh_rollups keeps up to date
+rollup_tables = ['weekly_distance', 'weekly_zone_time']
+
+def refresh_rollups(conn, timestamps = None):
+
+    # serialising refreshes until commit, as concurrent loaders (club threads, the webhook) would otherwise overwrite each other's week totals
+    with conn.cursor() as cur:
+        cur.execute("""SELECT pg_advisory_xact_lock(hashtext('weekly_rollups'));""")
+
+    # keeping the app's precomputed tables in step with the activities table (created by migrations.py)
+    refresh_weekly_distance(conn, timestamps)
+    refresh_weekly_zone_time(conn, timestamps)
+
+def verify_rollups(conn):
+
+    # comparing the incrementally maintained rollups with a full rebuild, which is rolled back afterwards
+    queries = {
+        'weekly_distance': """SELECT * FROM weekly_distance ORDER BY week;""",
+        'weekly_zone_time': """SELECT * FROM weekly_zone_time ORDER BY week, zone;"""}
+
+    conn.commit()
+    incremental = {table_name: fetch(conn, query) for table_name, query in queries.items()}
+    refresh_rollups(conn)
+    rebuilt = {table_name: fetch(conn, query) for table_name, query in queries.items()}
+    conn.rollback()
+
+    def same_value(a, b):
+        if a is None or b is None or not isinstance(a, (int, float, Decimal)):
+            return a == b
+        # allowing for distances summed as reals in a different order
+        return math.isclose(float(a), float(b), rel_tol = 1e-5, abs_tol = 1e-6)
+
+    mismatched_weeks = {}
+    for table_name in queries:
+        rows = incremental[table_name]
+        rebuilt_rows = rebuilt[table_name]
+        mismatches = sorted(set(rebuilt_row[0] for row, rebuilt_row in zip(rows, rebuilt_rows) if not all(same_value(a, b) for a, b in zip(row, rebuilt_row))))
+        if len(rows) != len(rebuilt_rows) or mismatches:
+            mismatched_weeks[table_name] = mismatches or ['{} rows instead of {}'.format(len(rows), len(rebuilt_rows))]
+
+    return mismatched_weeks
+
+# notifying the app of new data
+
+def notify_data_changed(conn, tables):
+
+    # queued with the transaction, so the app only hears about changes once they are committed
+    if tables:
+        with conn.cursor() as cur:
+            cur.execute("""SELECT pg_notify(%s, %s);""", (data_changed_channel, ','.join(tables)))
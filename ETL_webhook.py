@@ -0,0 +1,144 @@
+# importing libaries
+
+import json
+import time
+import queue
+import argparse
+import threading
+import requests
+import psycopg2
+from flask import Flask, request, jsonify
+import ETL_pipeline_functions
+
+# receiving Strava push subscription events
+
+app = Flask(__name__)
+
+## token Strava echoes back when validating the subscription
+verify_token = None
+## events waiting to be ingested, handled one at a time and in arrival order
+events = queue.Queue()
+
+def ingest_activity(activity_id):
+    # storing credentials for Strava and Google Geocoding API's
+    strava_access_token = ETL_pipeline_functions.strava_token_exchange('.secret/strava_api_credentials.json')
+    geocode_key = ETL_pipeline_functions.geocode_key_getter('.secret/geocode_api_credentials.json')
+
+    # making request to activity endpoint for Strava API (raising on errors, so a failed request never deletes a run)
+    activity = ETL_pipeline_functions.request_activity(strava_access_token, activity_id)
+
+    # creating connection to postgresSQL database
+    with psycopg2.connect(host="localhost", database="running_data", user="jacktann", password="Buster#19") as conn:
+        # removing activities Strava returned that are no longer runs (e.g. re-labelled as rides)
+        if activity.get('type') != 'Run':
+            ETL_pipeline_functions.delete_activities(conn, [activity_id])
+            return print("activity {} is not a run, removed".format(activity_id))
+
+        # cleaning and engineering the activity
+        geocode_cache = ETL_pipeline_functions.load_geocode_cache('data/geocode_cache.json')
+        activities = list(ETL_pipeline_functions.engineered_activities([activity], geocode_key, geocode_cache))
+        ETL_pipeline_functions.save_geocode_cache(geocode_cache, 'data/geocode_cache.json')
+
+        # making concurrent requests to laps and zones endpoints for Strava API
+        splits, zones = ETL_pipeline_functions.processed_splits_and_zones(strava_access_token, [activity_id])
+
+        # upserting so repeated create and update events leave a single copy
+        ETL_pipeline_functions.bulk_load(conn, activities, splits, zones)
+
+    return print("activity {} loaded".format(activity_id))
+
+def remove_activity(activity_id):
+    # creating connection to postgresSQL database
+    with psycopg2.connect(host="localhost", database="running_data", user="jacktann", password="Buster#19") as conn:
+        ETL_pipeline_functions.delete_activities(conn, [activity_id])
+
+    return print("activity {} deleted".format(activity_id))
+
+def handle_event(event):
+    # skipping athlete events (e.g. deauthorisations)
+    if event.get('object_type') != 'activity':
+        return
+
+    if event['aspect_type'] == 'delete':
+        remove_activity(event['object_id'])
+    else:
+        ingest_activity(event['object_id'])
+
+    ETL_pipeline_functions.advance_watermark('webhook', event['event_time'])
+
+def event_worker():
+    while True:
+        event = events.get()
+        try:
+            handle_event(event)
+        except Exception as e:
+            # leaving missed creates to the next polling run of ETL_pipeline.py
+            print("{} event for activity {} failed: {}".format(event.get('aspect_type'), event.get('object_id'), e))
+        finally:
+            events.task_done()
+
+@app.route('/webhook', methods = ['GET'])
+def validate_subscription():
+    if request.args.get('hub.mode') != 'subscribe' or request.args.get('hub.verify_token') != verify_token:
+        return jsonify({'error': 'invalid verify token'}), 403
+
+    return jsonify({'hub.challenge': request.args.get('hub.challenge')})
+
+@app.route('/webhook', methods = ['POST'])
+def receive_event():
+    # acknowledging straight away as Strava expects a response within two seconds
+    events.put(request.get_json(force = True))
+
+    return '', 200
+
+def serve(port):
+    threading.Thread(target = event_worker, daemon = True).start()
+    app.run(host = '0.0.0.0', port = port, threaded = True)
+
+# simulating Strava push subscription events
+
+def simulate_subscription(url, token):
+    params = {'hub.mode': 'subscribe', 'hub.verify_token': token, 'hub.challenge': 'simulated-challenge'}
+    response = requests.get(url, params = params)
+
+    return print(response.status_code, response.text.strip())
+
+def simulate_event(url, aspect_type, object_id, owner_id = 0, updates = None):
+    event = {
+        'aspect_type': aspect_type,
+        'event_time': int(time.time()),
+        'object_id': object_id,
+        'object_type': 'activity',
+        'owner_id': owner_id,
+        'subscription_id': 0,
+        'updates': updates or {}}
+    response = requests.post(url, json = event)
+
+    return print(response.status_code)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Receive (or simulate) Strava webhook events and load single activities.')
+    subparsers = parser.add_subparsers(dest = 'command', required = True)
+
+    serve_parser = subparsers.add_parser('serve', help = 'run the webhook receiver')
+    serve_parser.add_argument('--port', type = int, default = 5000)
+
+    validate_parser = subparsers.add_parser('validate', help = 'simulate a subscription validation request')
+    validate_parser.add_argument('--url', default = 'http://localhost:5000/webhook')
+
+    simulate_parser = subparsers.add_parser('simulate', help = 'simulate an activity event')
+    simulate_parser.add_argument('aspect_type', choices = ['create', 'update', 'delete'])
+    simulate_parser.add_argument('activity_id', type = int)
+    simulate_parser.add_argument('--url', default = 'http://localhost:5000/webhook')
+
+    args = parser.parse_args()
+
+    with open('.secret/strava_webhook_credentials.json', 'r') as r:
+        verify_token = json.load(r)['verify_token']
+
+    if args.command == 'serve':
+        serve(args.port)
+    elif args.command == 'validate':
+        simulate_subscription(args.url, verify_token)
+    else:
+        simulate_event(args.url, args.aspect_type, args.activity_id)
@@ -0,0 +1,186 @@
+# pooled access to the Heroku postgresql database, one pool per gunicorn worker
+
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+import pandas as pd
+import psycopg2
+from psycopg2 import pool
+
+# pool settings
+
+## file holding host, database, user and password
+credentials_file = '.secret/postgres_credentials.json'
+## connections opened when the pool is created
+min_connections = 1
+## connections each worker may hold open at once (Heroku's hobby plans allow 20 in total)
+max_connections = 4
+## seconds a caller waits for a free connection before giving up
+borrow_timeout = 30
+## seconds a connection may sit idle before it is checked with a round trip when borrowed
+liveness_check_after = 30
+## times a query is retried on a fresh connection after the connection drops
+query_retries = 1
+
+# pool state
+
+connection_pool = None
+pool_pid = None
+pool_lock = threading.Lock()
+## limiting borrowers to max_connections, as ThreadedConnectionPool raises rather than waits when exhausted
+pool_slots = threading.BoundedSemaphore(max_connections)
+## time each pooled connection was last returned, by connection id
+last_used = {}
+
+metrics_lock = threading.Lock()
+metrics = {'borrows': 0, 'in_use': 0, 'max_in_use': 0, 'wait_seconds': 0.0, 'timeouts': 0, 'liveness_checks': 0, 'reconnects': 0, 'query_errors': 0, 'retries': 0, 'queries': 0, 'query_seconds': 0.0}
+
+def count_metric(name, n = 1):
+
+    with metrics_lock:
+        metrics[name] += n
+
+def pool_metrics():
+
+    with metrics_lock:
+        pool_metrics = dict(metrics)
+
+    pool_metrics['max_connections'] = max_connections
+    pool_metrics['pid'] = os.getpid()
+
+    return pool_metrics
+
+# creating the pool
+
+def database_credentials(file_name = None):
+
+    with open(file_name or credentials_file, 'r') as r:
+        postgres_credentials = json.load(r)
+
+    return {key: postgres_credentials[key] for key in ['host', 'database', 'user', 'password']}
+
+def get_pool():
+
+    global connection_pool, pool_pid, pool_slots
+
+    # creating the pool lazily in each process, so connections are never shared across forked gunicorn workers
+    with pool_lock:
+        if connection_pool is None or pool_pid != os.getpid():
+            connection_pool = pool.ThreadedConnectionPool(min_connections, max_connections, **database_credentials())
+            pool_pid = os.getpid()
+            pool_slots = threading.BoundedSemaphore(max_connections)
+            last_used.clear()
+
+    return connection_pool
+
+def close_pool():
+
+    global connection_pool
+
+    with pool_lock:
+        if connection_pool is not None and pool_pid == os.getpid():
+            connection_pool.closeall()
+        connection_pool = None
+
+# borrowing connections
+
+def is_alive(conn):
+
+    if conn.closed:
+        return False
+
+    # only paying for a round trip when the connection has been idle a while
+    if time.time() - last_used.get(id(conn), 0) < liveness_check_after:
+        return True
+
+    count_metric('liveness_checks')
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1;")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+def live_connection(connection_pool):
+
+    conn = connection_pool.getconn()
+
+    # replacing connections the server (or network) has dropped, e.g. every idle one after a database restart
+    for attempt in range(max_connections):
+        if is_alive(conn):
+            break
+        connection_pool.putconn(conn, close = True)
+        last_used.pop(id(conn), None)
+        count_metric('reconnects')
+        conn = connection_pool.getconn()
+
+    return conn
+
+@contextmanager
+def connection():
+
+    connection_pool = get_pool()
+    slots = pool_slots
+
+    start = time.perf_counter()
+    if not slots.acquire(timeout = borrow_timeout):
+        count_metric('timeouts')
+        raise pool.PoolError("no database connection free after {} seconds".format(borrow_timeout))
+
+    with metrics_lock:
+        metrics['borrows'] += 1
+        metrics['wait_seconds'] += time.perf_counter() - start
+        metrics['in_use'] += 1
+        metrics['max_in_use'] = max(metrics['max_in_use'], metrics['in_use'])
+
+    conn = None
+    broken = False
+
+    try:
+        conn = live_connection(connection_pool)
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        # discarding connections that failed mid-query rather than handing them to the next caller
+        broken = True
+        raise
+    finally:
+        if conn is not None:
+            if not broken and not conn.closed:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    broken = True
+            last_used[id(conn)] = time.time()
+            connection_pool.putconn(conn, close = broken or bool(conn.closed))
+            if broken or conn.closed:
+                last_used.pop(id(conn), None)
+        slots.release()
+        count_metric('in_use', -1)
+
+# running queries
+
+def read_sql(query, params = None):
+
+    # retrying on a fresh connection if the borrowed one drops mid-query
+    for attempt in range(query_retries + 1):
+        start = time.perf_counter()
+        try:
+            # executing on a cursor rather than with pd.read_sql_query, which hides dropped connections behind its own error
+            with connection() as conn, conn.cursor() as cur:
+                cur.execute(query, params)
+                df = pd.DataFrame.from_records(cur.fetchall(), columns = [column[0] for column in cur.description], coerce_float = True)
+            break
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            count_metric('query_errors')
+            if attempt == query_retries:
+                raise
+            count_metric('retries')
+
+    count_metric('queries')
+    count_metric('query_seconds', time.perf_counter() - start)
+
+    return df
@@ -0,0 +1,188 @@
+# keeping the app's dataframes up to date with the database, refreshed in the background of each gunicorn worker
+
+import os
+import time
+import select
+import threading
+
+import psycopg2
+
+import db
+import queries
+
+# refresh settings
+
+## channel the ETL pipeline notifies (with the changed tables as payload) when it commits new data
+data_changed_channel = 'running_data_changed'
+## seconds between checks of the tables' change counters, in case a notification was missed
+probe_interval = 60
+## seconds to wait for further notifications before reloading, as the ETL commits one batch at a time
+settle_seconds = 2
+## seconds to wait before reconnecting after the refresher loses its connection
+retry_seconds = 10
+
+## query and source tables of each dataframe
+frame_sources = {
+    'df_1': (queries.weekly_distance_query, ['weekly_distance']),
+    'df_2': (queries.monthly_run_types_query, ['activities']),
+    'df_3': (queries.weekly_zone_time_query, ['weekly_zone_time']),
+    'df_4': (queries.parkrun_splits_query, ['activities', 'activity_splits']),
+    'df_5': (queries.parkrun_progress_query, ['activities']),
+    'df_6': (queries.parkrun_best_times_query, ['activities'])
+}
+
+## tables any dataframe is read from
+source_tables = sorted(set(table_name for query, tables in frame_sources.values() for table_name in tables))
+
+# snapshot state, replaced as a whole so callbacks never see a half-updated set of dataframes
+
+snapshot = None
+snapshot_lock = threading.Lock()
+refresher_thread = None
+refresher_pid = None
+
+# loading dataframes
+
+## converting seconds in MM:SS format
+def seconds_to_MMSS(total_seconds):
+    minutes = total_seconds // 60
+    seconds = total_seconds - (minutes * 60)
+    return '{}:{:02}'.format(minutes, seconds)
+
+def load_frame(name):
+
+    df = db.read_sql(frame_sources[name][0])
+
+    # re-formatting times and offsetting lollipop lines once here, rather than in callbacks sharing the dataframe
+    if name == 'df_5':
+        df['adjusted_time_diff'] = df.time_diff.map(lambda x: x - 1.5 if x > 0 else (x + 1.5 if x < 0 else 0))
+        df['chip_time'] = df['chip_time'].map(lambda x: seconds_to_MMSS(x))
+    if name == 'df_6':
+        df['best_time'] = df['best_time'].apply(lambda x: seconds_to_MMSS(x))
+
+    return df
+
+def table_versions():
+
+    # counting every insert, update and delete on the source tables (statistics Postgres already keeps)
+    df = db.read_sql("""
+SELECT
+    relname AS table_name,
+    n_tup_ins + n_tup_upd + n_tup_del AS changes
+FROM pg_stat_user_tables
+WHERE relname = ANY(%(tables)s) AND schemaname = current_schema();""", {'tables': source_tables})
+
+    return dict(zip(df.table_name, df.changes))
+
+def changed_frames(changed_tables):
+
+    return [name for name, (query, tables) in frame_sources.items() if set(tables) & set(changed_tables)]
+
+def refresh_frames(names, versions = None):
+
+    global snapshot
+
+    # loading off the request path, then swapping the whole snapshot in one assignment
+    loaded = {name: load_frame(name) for name in names}
+
+    with snapshot_lock:
+        frames = dict(snapshot['frames']) if snapshot else {}
+        frames.update(loaded)
+        snapshot = {
+            'frames': frames,
+            'versions': versions if versions is not None else (snapshot['versions'] if snapshot else {}),
+            'loaded_at': time.time()}
+
+    return loaded
+
+def current_frames():
+
+    global snapshot
+
+    # loading every dataframe the first time a worker needs them
+    if snapshot is None:
+        with snapshot_lock:
+            if snapshot is None:
+                versions = table_versions()
+                snapshot = {'frames': {name: load_frame(name) for name in frame_sources}, 'versions': versions, 'loaded_at': time.time()}
+
+    start_refresher()
+
+    return snapshot['frames']
+
+# refreshing in the background
+
+def listen_connection():
+
+    conn = psycopg2.connect(**db.database_credentials())
+    conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    with conn.cursor() as cur:
+        cur.execute("LISTEN {};".format(data_changed_channel))
+
+    return conn
+
+def wait_for_changes(conn, timeout):
+
+    # returning the tables named in notifications, or an empty set after the timeout
+    changed_tables = set()
+    deadline = time.time() + timeout
+
+    while time.time() < deadline:
+        if select.select([conn], [], [], max(0, deadline - time.time())) == ([], [], []):
+            break
+        conn.poll()
+        while conn.notifies:
+            notify = conn.notifies.pop(0)
+            changed_tables.update(filter(None, notify.payload.split(',')))
+        if changed_tables:
+            # collecting the rest of a multi-batch load before reloading
+            deadline = min(deadline, time.time() + settle_seconds)
+
+    return changed_tables
+
+def refresh_once(conn):
+
+    changed_tables = wait_for_changes(conn, probe_interval)
+
+    # probing change counters on every wake up, catching loads that didn't notify (or were missed while reconnecting)
+    versions = table_versions()
+    previous_versions = snapshot['versions'] if snapshot else {}
+    changed_tables.update(table_name for table_name in source_tables if versions.get(table_name) != previous_versions.get(table_name))
+
+    names = changed_frames(changed_tables)
+    if names:
+        refresh_frames(names, versions)
+        print("refreshed {} after changes to {}".format(', '.join(names), ', '.join(sorted(changed_tables))))
+    elif versions != previous_versions:
+        with snapshot_lock:
+            snapshot['versions'] = versions
+
+    return names
+
+def refresh_forever():
+
+    conn = None
+
+    while True:
+        try:
+            if conn is None or conn.closed:
+                conn = listen_connection()
+            refresh_once(conn)
+        except Exception as e:
+            # keeping the last good snapshot and trying again later
+            print("refresh failed: {}".format(e))
+            if conn is not None and not conn.closed:
+                conn.close()
+            conn = None
+            time.sleep(retry_seconds)
+
+def start_refresher():
+
+    global refresher_thread, refresher_pid
+
+    # starting one refresher per process, as threads don't survive gunicorn forking workers
+    with snapshot_lock:
+        if refresher_thread is None or not refresher_thread.is_alive() or refresher_pid != os.getpid():
+            refresher_thread = threading.Thread(target = refresh_forever, name = 'frame-refresher', daemon = True)
+            refresher_thread.start()
+            refresher_pid = os.getpid()
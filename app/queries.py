@@ -0,0 +1,121 @@
+# SQL queries behind the app's figures, shared with the migrations' EXPLAIN check
+
+## weekly distances and 6-week moving averages, kept up to date by the ETL pipeline (first figure, first tab)
+weekly_distance_query = """
+SELECT 
+    week,
+    ROUND(total_distance::numeric, 1) AS total_distance,
+    ROUND(simple_moving_avg::numeric, 1) AS moving_avg,
+    ROUND((simple_moving_avg - moving_std)::numeric, 1) AS lower_bound,
+    ROUND((simple_moving_avg + moving_std)::numeric, 1) AS upper_bound
+FROM weekly_distance
+WHERE simple_moving_avg IS NOT NULL AND (EXTRACT(WEEK FROM week) = 1 OR EXTRACT(YEAR FROM week) > 2018)
+ORDER BY 1;
+"""
+
+## number of runs of each type per month (second figure, first tab)
+monthly_run_types_query = """
+WITH run_types (run_type) AS (VALUES ('S'), ('M'), ('L'), ('I')),
+sub_1a AS(
+SELECT
+    date_trunc('month', MIN(timestamp)) AS min_date,
+    date_trunc('month', MAX(timestamp)) AS max_date
+FROM activities),
+sub_1b AS(
+SELECT 
+    generate_series(min_date, max_date, '1 month'::interval) AS month
+FROM sub_1a),
+sub_1c AS(
+SELECT 
+    month,
+    run_type
+FROM sub_1b
+CROSS JOIN run_types),
+sub_1d AS(
+SELECT
+    date_trunc('month', timestamp) AS month, 
+    run_type, 
+    COUNT(*) AS n_runs
+FROM activities 
+WHERE run_type NOT IN ('WU', 'WD')
+GROUP BY 1, 2
+ORDER BY 1, 2),
+sub_1e AS(
+SELECT 
+    b.month,
+    b.run_type,
+    coalesce(n_runs, 0) AS n_runs
+FROM sub_1d a
+RIGHT JOIN sub_1c b
+ON a.month = b.month AND a.run_type = b.run_type)
+SELECT 
+    month,
+    run_type,
+    n_runs,
+    RANK() OVER(PARTITION BY month ORDER BY n_runs) AS rt_rank
+FROM sub_1e
+WHERE EXTRACT(YEAR FROM month) > 2018
+ORDER BY 1, 2;
+"""
+
+## weekly heart rate zone time and 6-week zone shares, kept up to date by the ETL pipeline (third figure, first tab)
+weekly_zone_time_query = """
+SELECT 
+    week,
+    zone,
+    time,
+    ROUND(moving_percentage, 1) AS moving_percentage
+FROM weekly_zone_time
+WHERE moving_percentage IS NOT NULL AND (EXTRACT(WEEK FROM week) = 1 OR EXTRACT(YEAR FROM week) > 2018)
+ORDER BY 1, 2;
+"""
+
+## parkrun split times and heart rates (third and fourth figures, second tab)
+parkrun_splits_query = """
+SELECT
+    CAST(timestamp::date AS TEXT) AS date,
+    location,
+    split_index,
+    ((1/b.average_speed) * 3600)::int AS split_time,
+    b.average_hr AS average_hr,
+    (AVG(b.average_hr) OVER(PARTITION BY location, split_index))::int AS total_average_hr
+FROM activities a
+RIGHT JOIN activity_splits b
+ON a.id = b.activity_id
+WHERE event_type = 'PR' AND split_index <= 5 AND timestamp::date != '2019-11-09'
+ORDER BY 1, 3;
+"""
+
+## parkrun chip times against the best time at each location so far (first figure, second tab)
+parkrun_progress_query = """
+WITH sub_1 AS(
+SELECT
+    timestamp,
+    location,
+    chip_time,
+    position,
+    MIN(chip_time) OVER(PARTITION BY location ORDER BY timestamp ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING) AS best_time
+FROM activities
+WHERE event_type = 'PR' AND timestamp::date != '2019-11-09')
+SELECT 
+    ROW_NUMBER() OVER(PARTITION BY location ORDER BY timestamp) AS n,
+    CAST(timestamp::date AS TEXT) AS date,
+    location,
+    chip_time,
+    position,
+    coalesce(best_time, chip_time) - chip_time AS time_diff
+FROM sub_1
+ORDER BY 1;
+"""
+
+## best parkrun time at each location per year (second figure, second tab)
+parkrun_best_times_query = """
+SELECT
+    EXTRACT(YEAR FROM timestamp)::int AS year,
+    location,
+    MIN(chip_time) AS best_time
+FROM activities a
+WHERE event_type = 'PR'
+GROUP BY 1, 2
+ORDER BY 1, 2;
+"""
@@ -0,0 +1,234 @@
+# benchmarking each ETL function and the end-to-end pipeline on synthetic data, storing results per commit
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import ETL_pipeline_functions
+import synthetic_data
+from stub_server import start_stub_server
+
+## file each benchmark run appends its results to
+results_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results.jsonl')
+## activities generated and timed at once, so a million activities never sit in memory together
+chunk_size = 10000
+
+# synthetic inputs
+
+def chunks(n, make_chunk):
+
+    for first_id in range(1, n + 1, chunk_size):
+        yield make_chunk(first_id, min(first_id + chunk_size - 1, n))
+
+def raw_activities(first_id, last_id):
+
+    return synthetic_data.synthetic_activities(first_id, last_id)
+
+def clean_runs(first_id, last_id):
+
+    return [ETL_pipeline_functions.clean_activity(activity) for activity in raw_activities(first_id, last_id) if activity['type'] == 'Run']
+
+def raw_laps(first_id, last_id):
+
+    return [(activity_id, synthetic_data.synthetic_laps(activity_id)) for activity_id in range(first_id, last_id + 1)]
+
+def raw_zones(first_id, last_id):
+
+    return [(activity_id, synthetic_data.synthetic_zones(activity_id)) for activity_id in range(first_id, last_id + 1)]
+
+def engineered_runs(first_id, last_id):
+
+    return [ETL_pipeline_functions.engineer_activity(activity, 'stub-key', geocode_cache) for activity in clean_runs(first_id, last_id)]
+
+# benchmarked functions
+
+def bench_clean_activity(activities):
+
+    for activity in activities:
+        ETL_pipeline_functions.clean_activity(activity)
+
+def bench_engineer_activity(activities):
+
+    for activity in activities:
+        ETL_pipeline_functions.engineer_activity(activity, 'stub-key', geocode_cache)
+
+def bench_clean_splits(laps):
+
+    for activity_id, activity_laps in laps:
+        ETL_pipeline_functions.clean_splits(activity_laps, activity_id)
+
+def bench_clean_zones(zones):
+
+    for activity_id, activity_zones in zones:
+        ETL_pipeline_functions.clean_zones(activity_zones, activity_id)
+
+def bench_insert_statement(activities):
+
+    for activity in activities:
+        ETL_pipeline_functions.insert_statement("activities", activity)
+
+## benchmark name, function timed on each chunk and the synthetic input it takes
+function_benchmarks = [
+    ('clean_activity', bench_clean_activity, raw_activities),
+    ('engineer_activity', bench_engineer_activity, clean_runs),
+    ('clean_splits', bench_clean_splits, raw_laps),
+    ('clean_zones', bench_clean_zones, raw_zones),
+    ('insert_statement', bench_insert_statement, engineered_runs)
+]
+
+def timed_chunks(function, n, make_chunk):
+
+    # timing only the function, not generating its input
+    elapsed = 0
+    n_items = 0
+
+    for chunk in chunks(n, make_chunk):
+        start = time.perf_counter()
+        function(chunk)
+        elapsed += time.perf_counter() - start
+        n_items += len(chunk)
+
+    return n_items, elapsed
+
+def end_to_end(n, conn = None, batch_size = ETL_pipeline_functions.max_per_page):
+
+    # fetching, engineering, hydrating and (optionally) loading every run from the stub server
+    start = time.perf_counter()
+    n_items = 0
+
+    activities_stream = ETL_pipeline_functions.stream_activities('stub-token', 'stub-key', geocode_cache = geocode_cache)
+    for activities in ETL_pipeline_functions.batched(activities_stream, batch_size):
+        activity_ids = [activity['id'] for activity in activities]
+        splits, zones = ETL_pipeline_functions.processed_splits_and_zones('stub-token', activity_ids)
+        if conn is not None:
+            ETL_pipeline_functions.bulk_load(conn, activities, splits, zones)
+        n_items += len(activities)
+
+    return n_items, time.perf_counter() - start
+
+# storing and comparing results
+
+def current_commit():
+
+    repo_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd = repo_dir, stderr = subprocess.DEVNULL).decode().strip()
+        dirty = bool(subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd = repo_dir, stderr = subprocess.DEVNULL).strip())
+    except (OSError, subprocess.CalledProcessError):
+        commit, dirty = 'unknown', False
+
+    return commit, dirty
+
+def read_results(file_name = None):
+
+    try:
+        with open(file_name or results_file, 'r') as r:
+            return [json.loads(line) for line in r if line.strip()]
+    except FileNotFoundError:
+        return []
+
+def baseline_results(results, commit, compare_to = None):
+
+    # defaulting to the latest run of any other commit
+    if compare_to is None:
+        other_commits = [result['commit'] for result in results if result['commit'] != commit]
+        if not other_commits:
+            return {}
+        compare_to = other_commits[-1]
+
+    return {(result['benchmark'], result['size']): result for result in results if result['commit'].startswith(compare_to)}
+
+def main():
+
+    global geocode_cache
+
+    parser = argparse.ArgumentParser(description = 'Time ETL functions and the end-to-end pipeline on synthetic data, and compare with earlier commits.')
+    parser.add_argument('--sizes', type = int, nargs = '+', default = [1000, 10000], help = 'numbers of activities for the function benchmarks (up to 1000000)')
+    parser.add_argument('--end-to-end', type = int, default = 1000, help = 'number of activities served by the stub server (0 to skip)')
+    parser.add_argument('--latency', type = float, default = 0.0, help = 'stub server latency per request (seconds)')
+    parser.add_argument('--dsn', help = 'postgres dsn to also load the end-to-end run into (a load_benchmark schema is created and dropped)')
+    parser.add_argument('--only', nargs = '+', help = 'names of benchmarks to run')
+    parser.add_argument('--compare', help = 'commit to compare against (defaults to the latest other commit in the results file)')
+    parser.add_argument('--results', default = results_file, help = 'json lines file results are appended to')
+    args = parser.parse_args()
+
+    # pointing the Strava and Google Geocoding API's at a local stub serving synthetic payloads
+    server, base_url = start_stub_server(latency = args.latency, total_activities = args.end_to_end, synthetic = True)
+    server.RequestHandlerClass.rate_limits = (10 ** 9, 10 ** 9)
+    ETL_pipeline_functions.strava_base_url = base_url
+    ETL_pipeline_functions.geocode_base_url = base_url
+    # keeping rate limit usage and cached locations out of the real data directory
+    state_dir = tempfile.mkdtemp()
+    ETL_pipeline_functions.rate_limit_file = os.path.join(state_dir, 'rate_limit_state.json')
+    ETL_pipeline_functions.rate_limit_state = None
+    geocode_cache = ETL_pipeline_functions.load_geocode_cache(os.path.join(state_dir, 'geocode_cache.json'))
+
+    commit, dirty = current_commit()
+    results = read_results(args.results)
+    baseline = baseline_results(results, commit, args.compare)
+
+    runs = [(name, function, make_chunk, n) for n in args.sizes for name, function, make_chunk in function_benchmarks]
+    if args.end_to_end:
+        runs.append(('end_to_end', None, None, args.end_to_end))
+    if args.only:
+        runs = [run for run in runs if run[0] in args.only]
+
+    print("commit {}{}".format(commit, ' (uncommitted changes)' if dirty else ''))
+    print("{:<18} {:>9} {:>10} {:>12} {:>10}".format('benchmark', 'size', 'seconds', 'items/s', 'vs base'))
+
+    conn = None
+    if args.dsn:
+        import psycopg2
+        from load_benchmark import reset_schema
+        conn = psycopg2.connect(args.dsn)
+        reset_schema(conn)
+
+    new_results = []
+
+    for name, function, make_chunk, n in runs:
+        if name == 'end_to_end':
+            n_items, elapsed = end_to_end(n, conn)
+        else:
+            n_items, elapsed = timed_chunks(function, n, make_chunk)
+
+        result = {
+            'commit': commit,
+            'dirty': dirty,
+            'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(),
+            'machine': platform.node(),
+            'benchmark': name,
+            'size': n,
+            'items': n_items,
+            'seconds': round(elapsed, 6),
+            'items_per_second': round(n_items / elapsed, 1) if elapsed else None}
+        new_results.append(result)
+
+        # showing the speed up (or slow down) against the baseline commit
+        base = baseline.get((name, n))
+        change = "{:.2f}x".format(result['items_per_second'] / base['items_per_second']) if base and base['items_per_second'] and result['items_per_second'] else '-'
+        print("{:<18} {:>9} {:>10.3f} {:>12.0f} {:>10}".format(name, n, elapsed, result['items_per_second'] or 0, change))
+
+    if conn is not None:
+        with conn.cursor() as cur:
+            cur.execute("DROP SCHEMA load_benchmark CASCADE;")
+        conn.commit()
+        conn.close()
+
+    with open(args.results, 'a') as a:
+        for result in new_results:
+            a.write(json.dumps(result) + "\n")
+
+    server.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+# benchmarking serial vs concurrent laps and zones requests against a local stub server
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import ETL_pipeline_functions
+from stub_server import start_stub_server
+
+def serial_fetch(activity_ids):
+
+    splits = ETL_pipeline_functions.processed_splits('stub-token', activity_ids, max_workers = 1)
+    zones = ETL_pipeline_functions.processed_zones('stub-token', activity_ids, max_workers = 1)
+
+    return splits, zones
+
+def concurrent_fetch(activity_ids, max_workers):
+
+    return ETL_pipeline_functions.processed_splits_and_zones('stub-token', activity_ids, max_workers = max_workers)
+
+def timed(function, *args):
+
+    start = time.perf_counter()
+    output = function(*args)
+    elapsed = time.perf_counter() - start
+
+    return output, elapsed
+
+def main():
+
+    parser = argparse.ArgumentParser(description = 'Compare serial and concurrent laps/zones fetching.')
+    parser.add_argument('--activities', type = int, default = 200)
+    parser.add_argument('--latency', type = float, default = 0.05, help = 'stub server latency per request (seconds)')
+    parser.add_argument('--workers', type = int, nargs = '+', default = [4, 8, 16, 32])
+    args = parser.parse_args()
+
+    server, base_url = start_stub_server(latency = args.latency)
+    server.RequestHandlerClass.rate_limits = (10 ** 9, 10 ** 9)
+    ETL_pipeline_functions.strava_base_url = base_url
+    # keeping the stub's rate limit usage out of the real data directory
+    ETL_pipeline_functions.rate_limit_file = os.path.join(tempfile.mkdtemp(), 'rate_limit_state.json')
+    ETL_pipeline_functions.rate_limit_state = None
+
+    activity_ids = list(range(1, args.activities + 1))
+
+    print("{} activities, {:.0f}ms latency per request".format(args.activities, args.latency * 1000))
+
+    serial_output, serial_time = timed(serial_fetch, activity_ids)
+    print("serial:          {:8.2f}s".format(serial_time))
+
+    for max_workers in args.workers:
+        concurrent_output, concurrent_time = timed(concurrent_fetch, activity_ids, max_workers)
+        assert concurrent_output == serial_output, "concurrent results differ from serial results"
+        print("workers = {:<4}  {:8.2f}s  ({:.1f}x)".format(max_workers, concurrent_time, serial_time / concurrent_time))
+
+    server.shutdown()
+
+if __name__ == '__main__':
+    main()
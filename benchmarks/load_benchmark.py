@@ -0,0 +1,92 @@
+# benchmarking per-row INSERT + commit vs bulk loading against a postgres database
+
+import argparse
+import io
+import os
+import sys
+import time
+from contextlib import redirect_stdout
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import psycopg2
+import ETL_pipeline_functions
+import migrations
+from stub_server import stub_activity, stub_laps, stub_zones
+
+def synthetic_records(n):
+
+    activities = []
+    splits = []
+    zones = []
+
+    for activity_id in range(1, n + 1):
+        activity = ETL_pipeline_functions.engineer_activity(ETL_pipeline_functions.clean_activity(stub_activity(activity_id)), None)
+        activity.pop('activity_type', None)
+        activity.pop('start_time', None)
+        activities.append(activity)
+        splits += ETL_pipeline_functions.clean_splits(stub_laps(activity_id), activity_id)
+        zones += ETL_pipeline_functions.clean_zones(stub_zones(activity_id), activity_id)
+
+    return activities, splits, zones
+
+def reset_schema(conn):
+
+    with conn.cursor() as cur:
+        cur.execute("DROP SCHEMA IF EXISTS load_benchmark CASCADE; CREATE SCHEMA load_benchmark; SET search_path TO load_benchmark;")
+    conn.commit()
+
+    # building the tables (rollups included) with the pipeline's own migrations, without printing each one
+    with redirect_stdout(io.StringIO()):
+        migrations.migrate(conn)
+
+def per_row_load(conn, activities, splits, zones):
+
+    for activity in activities:
+        ETL_pipeline_functions.commit(conn, ETL_pipeline_functions.insert_statement("activities", activity))
+    for zone in zones:
+        ETL_pipeline_functions.commit(conn, ETL_pipeline_functions.insert_statement("activity_zones", zone))
+    for split in splits:
+        ETL_pipeline_functions.commit(conn, ETL_pipeline_functions.insert_statement("activity_splits", split))
+
+def bulk_load(conn, activities, splits, zones):
+
+    ETL_pipeline_functions.bulk_load(conn, activities, splits, zones)
+
+def timed_load(conn, load, records):
+
+    reset_schema(conn)
+    start = time.perf_counter()
+    load(conn, *records)
+    elapsed = time.perf_counter() - start
+
+    return elapsed
+
+def main():
+
+    parser = argparse.ArgumentParser(description = 'Compare per-row and bulk loading throughput.')
+    parser.add_argument('--dsn', default = os.environ.get('BENCHMARK_DSN', 'dbname=running_data_benchmark'))
+    parser.add_argument('--activities', type = int, default = 1000)
+    args = parser.parse_args()
+
+    records = synthetic_records(args.activities)
+    n_rows = sum(map(len, records))
+    print("{} activities, {} rows".format(args.activities, n_rows))
+
+    with psycopg2.connect(args.dsn) as conn:
+        for name, load in [('per-row commit', per_row_load), ('bulk load', bulk_load)]:
+            elapsed = timed_load(conn, load, records)
+            print("{:<15} {:8.2f}s  {:10.0f} rows/s".format(name, elapsed, n_rows / elapsed))
+
+        # re-running the bulk load over existing rows to check it is idempotent
+        bulk_load(conn, *records)
+        with conn.cursor() as cur:
+            cur.execute("SELECT (SELECT COUNT(*) FROM activities) + (SELECT COUNT(*) FROM activity_splits) + (SELECT COUNT(*) FROM activity_zones);")
+            assert cur.fetchone()[0] == n_rows, "re-running the bulk load duplicated rows"
+
+        with conn.cursor() as cur:
+            cur.execute("DROP SCHEMA load_benchmark CASCADE;")
+        conn.commit()
+
+if __name__ == '__main__':
+    main()
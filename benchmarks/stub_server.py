@@ -0,0 +1,156 @@
+# local stub of the Strava API used for benchmarking
+
+import json
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import synthetic_data
+
+# canned responses
+
+def stub_activity(activity_id):
+
+    start_date = datetime(2018, 8, 1) + timedelta(days = activity_id)
+    start_date_string = start_date.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    return {'id': activity_id, 'name': 'Morning Run', 'type': 'Run', 'start_date': start_date_string, 'start_date_local': start_date_string, 'distance': 10000.0, 'elapsed_time': 2700, 'start_latlng': [], 'total_elevation_gain': 40.0, 'average_speed': 3.7, 'max_speed': 5.2, 'average_heartrate': 148.0, 'max_heartrate': 171.0, 'average_cadence': 86.0, 'kudos_count': 3, 'suffer_score': 45}
+
+def stub_activities(total_activities, query, synthetic = False):
+
+    page = int(query.get('page', ['1'])[0])
+    per_page = int(query.get('per_page', ['30'])[0])
+    after = int(query.get('after', ['0'])[0])
+    before = int(query.get('before', ['0'])[0])
+
+    if not synthetic and not after and not before:
+        first_id = (page - 1) * per_page + 1
+        last_id = min(page * per_page, total_activities)
+        return [stub_activity(activity_id) for activity_id in range(first_id, last_id + 1)]
+
+    # filtering by start time when a window is asked for
+    if synthetic:
+        activities = synthetic_data.synthetic_activities_between(after, before, total_activities)
+    else:
+        activities = [activity for activity in map(stub_activity, range(1, total_activities + 1)) if (not after or synthetic_data.start_time(activity) > after) and (not before or synthetic_data.start_time(activity) < before)]
+
+    return activities[(page - 1) * per_page:page * per_page]
+
+def stub_laps(activity_id):
+
+    return [{'split': i, 'distance': 1000.0, 'elapsed_time': 240, 'total_elevation_gain': 5.0, 'average_speed': 4.2, 'max_speed': 5.1, 'average_heartrate': 150.0, 'max_heartrate': 165.0, 'average_cadence': 88.0} for i in range(1, 6)]
+
+def stub_zones(activity_id):
+
+    heartrate_buckets = [{'min': 0, 'max': 136, 'time': 120}, {'min': 136, 'max': 152, 'time': 600}, {'min': 152, 'max': 167, 'time': 300}, {'min': 167, 'max': 182, 'time': 60}, {'min': 182, 'max': -1, 'time': 0}]
+    pace_buckets = [{'min': 0, 'max': 3.35, 'time': 100}, {'min': 3.35, 'max': 3.9, 'time': 700}, {'min': 3.9, 'max': 4.35, 'time': 200}, {'min': 4.35, 'max': 4.65, 'time': 50}, {'min': 4.65, 'max': 4.95, 'time': 30}, {'min': 4.95, 'max': -1, 'time': 0}]
+
+    return [{'type': 'heartrate', 'distribution_buckets': heartrate_buckets}, {'type': 'pace', 'distribution_buckets': pace_buckets}]
+
+def stub_streams(activity_id):
+
+    n = 2700
+    time = list(range(n))
+    distance = [round(i * 3.7, 1) for i in range(n)]
+
+    return {
+        'time': {'data': time, 'series_type': 'distance', 'original_size': n, 'resolution': 'high'},
+        'distance': {'data': distance, 'series_type': 'distance', 'original_size': n, 'resolution': 'high'},
+        'heartrate': {'data': [120 + (i * 7) % 50 for i in range(n)], 'series_type': 'distance', 'original_size': n, 'resolution': 'high'},
+        'velocity_smooth': {'data': [3.7] * n, 'series_type': 'distance', 'original_size': n, 'resolution': 'high'},
+        'cadence': {'data': [86 + i % 4 for i in range(n)], 'series_type': 'distance', 'original_size': n, 'resolution': 'high'},
+        'altitude': {'data': [40.0 + (i % 100) / 10 for i in range(n)], 'series_type': 'distance', 'original_size': n, 'resolution': 'high'}}
+
+def stub_geocode(latlng):
+
+    return synthetic_data.synthetic_geocode(latlng)
+
+# request handler
+
+routes = [
+    (re.compile(r'^/activities/(\d+)$'), 'activity'),
+    (re.compile(r'^/activities/(\d+)/laps$'), 'laps'),
+    (re.compile(r'^/activities/(\d+)/zones$'), 'zones'),
+    (re.compile(r'^/activities/(\d+)/streams$'), 'streams')
+]
+
+## canned responses repeat the same activity, synthetic ones vary like a real history
+canned_responses = {'activity': stub_activity, 'laps': stub_laps, 'zones': stub_zones, 'streams': stub_streams}
+synthetic_responses = {'activity': synthetic_data.synthetic_activity, 'laps': synthetic_data.synthetic_laps, 'zones': synthetic_data.synthetic_zones, 'streams': stub_streams}
+
+class StubHandler(BaseHTTPRequestHandler):
+
+    # keeping connections alive between requests
+    protocol_version = 'HTTP/1.1'
+    # sending headers and body without waiting on delayed ACKs
+    disable_nagle_algorithm = True
+    # artificial round trip latency in seconds
+    latency = 0.05
+    # number of activities served by the paginated activities endpoint
+    total_activities = 1000
+    # rate limits reported in the X-RateLimit headers (15 minute, daily)
+    rate_limits = (600, 30000)
+    # serving synthetic_data payloads instead of canned ones
+    synthetic = False
+    request_count = 0
+
+    def send_json(self, response):
+
+        StubHandler.request_count += 1
+        usage = '{0},{0}'.format(StubHandler.request_count)
+
+        body = json.dumps(response).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('X-RateLimit-Limit', '{},{}'.format(*self.rate_limits))
+        self.send_header('X-RateLimit-Usage', usage)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+
+        time.sleep(self.latency)
+
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        responses = synthetic_responses if self.synthetic else canned_responses
+
+        if url.path == '/athlete/activities':
+            return self.send_json(stub_activities(self.total_activities, query, self.synthetic))
+
+        if url.path == '/geocode/json':
+            return self.send_json(stub_geocode([float(value) for value in query['latlng'][0].split(',')]))
+
+        for pattern, response in routes:
+            match = pattern.match(url.path)
+            if match:
+                return self.send_json(responses[response](int(match.group(1))))
+
+        self.send_response(404)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        return
+
+class StubServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+    # allowing a deep accept backlog so concurrent clients aren't refused
+    request_queue_size = 128
+
+def start_stub_server(latency = 0.05, port = 0, total_activities = 1000, synthetic = False):
+
+    # binding a handler subclass so each server keeps its own settings
+    handler = type('StubHandler', (StubHandler,), {'latency': latency, 'total_activities': total_activities, 'synthetic': synthetic})
+    server = StubServer(('127.0.0.1', port), handler)
+
+    thread = threading.Thread(target = server.serve_forever, daemon = True)
+    thread.start()
+
+    base_url = "http://127.0.0.1:{}".format(server.server_address[1])
+
+    return server, base_url
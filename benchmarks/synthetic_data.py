@@ -0,0 +1,245 @@
+# generating realistic Strava and Google Geocoding API payloads at any scale
+
+import argparse
+import calendar
+import json
+import math
+import os
+import random
+from datetime import datetime, timedelta
+
+# settings
+
+## first synthetic start time, activities follow every 90 minutes or so (a busy club rather than one athlete)
+first_start_date = datetime(2018, 8, 1, 7, 0)
+## towns activities start from, weighted roughly as in data/activities.csv
+towns = [
+    ('Welwyn Garden City', 51.8010, -0.2060, 60),
+    ('Hertford', 51.7960, -0.0780, 14),
+    ('Hatfield', 51.7630, -0.2260, 12),
+    ('London', 51.5070, -0.1280, 4),
+    ('Barnet', 51.6530, -0.2000, 2),
+    ('Watford', 51.6560, -0.3900, 2),
+    ('Waltham Cross', 51.6860, -0.0330, 2),
+    ('Harpenden', 51.8160, -0.3570, 1),
+    ('Knebworth', 51.8660, -0.1850, 1),
+    ('Stevenage', 51.9020, -0.2020, 2)]
+## share of activities recorded on a treadmill (no start location)
+treadmill_share = 0.03
+## share of activities recorded without a heart rate monitor
+no_heartrate_share = 0.2
+## share of uploads that aren't runs
+non_run_share = 0.08
+
+# activities
+
+def activity_rng(activity_id, seed, stream):
+
+    # seeding per activity so any page, lap or zone can be regenerated on its own
+    return random.Random("{}:{}:{}".format(seed, activity_id, stream))
+
+def race_result(rng, distance, elapsed_time):
+
+    position = rng.choice([1, 2, 3, 5, 8, 12, 21, 35, 48, 102, 240])
+    suffix = {1: 'st', 2: 'nd', 3: 'rd'}.get(position % 10 if position % 100 not in (11, 12, 13) else 0, 'th')
+    hours, seconds = divmod(elapsed_time, 3600)
+    chip_time = "{}:{:02d}:{:02d}".format(hours, seconds // 60, seconds % 60) if hours else "{:02d}:{:02d}".format(seconds // 60, seconds % 60)
+
+    return "({} - {}{})".format(chip_time, position, suffix)
+
+def synthetic_session(rng):
+
+    # picking the kind of run, its distance (km) and pace (s/km)
+    kind = rng.choices(['easy', 'long', 'intervals', 'warm up', 'warm down', 'parkrun', 'race'], weights = [55, 10, 14, 4, 2, 10, 5])[0]
+
+    if kind == 'easy':
+        return kind, rng.uniform(4, 12), rng.uniform(270, 330)
+    if kind == 'long':
+        return kind, rng.uniform(14, 32), rng.uniform(280, 320)
+    if kind == 'intervals':
+        return kind, rng.uniform(6, 12), rng.uniform(230, 270)
+    if kind in ('warm up', 'warm down'):
+        return kind, rng.uniform(1, 4), rng.uniform(300, 360)
+    if kind == 'parkrun':
+        return kind, rng.uniform(4.95, 5.1), rng.uniform(205, 235)
+
+    return kind, rng.choice([5, 10, 16.09, 21.1, 42.2]), rng.uniform(215, 250)
+
+def synthetic_name(rng, kind, distance, elapsed_time, start_date):
+
+    if kind in ('easy', 'long'):
+        part_of_day = 'Morning' if start_date.hour < 12 else 'Lunch' if start_date.hour < 15 else 'Evening'
+        return "{} Run".format(part_of_day)
+    if kind == 'intervals':
+        return rng.choice(["Intervals {}x800m".format(rng.randint(4, 10)), "Yasso 800s", "Track session", "Intervals 5x1k"])
+    if kind == 'warm up':
+        return rng.choice(["WU", "WU before race", "Pre race test"])
+    if kind == 'warm down':
+        return "WD"
+    if kind == 'parkrun':
+        return "{}parkrun {}".format("PR " if rng.random() < 0.15 else "", race_result(rng, distance, elapsed_time))
+
+    return "{} {}{}".format(rng.choice(['Hertford', 'St Albans', 'Welwyn', 'Stevenage', 'London']), "PR " if rng.random() < 0.2 else "", race_result(rng, distance, elapsed_time))
+
+def synthetic_latlng(rng):
+
+    if rng.random() < treadmill_share:
+        return []
+
+    # jittering starts within a few hundred metres of a town centre
+    town, lat, lng, weight = rng.choices(towns, weights = [town[3] for town in towns])[0]
+
+    return [round(lat + rng.gauss(0, 0.002), 6), round(lng + rng.gauss(0, 0.003), 6)]
+
+def synthetic_activity(activity_id, seed = 0):
+
+    rng = activity_rng(activity_id, seed, 'activity')
+
+    start_date = first_start_date + timedelta(minutes = 90 * activity_id + rng.randint(0, 60))
+    start_date_string = start_date.strftime("%Y-%m-%dT%H:%M:%SZ")
+    kind, distance, pace = synthetic_session(rng)
+    elapsed_time = int(distance * pace)
+    has_heartrate = rng.random() >= no_heartrate_share
+    average_heartrate = round(rng.uniform(135, 175), 1)
+
+    activity = {
+        'id': activity_id,
+        'name': synthetic_name(rng, kind, distance, elapsed_time, start_date),
+        'type': 'Run' if rng.random() >= non_run_share else rng.choice(['Ride', 'Walk', 'Swim']),
+        'start_date': start_date_string,
+        'start_date_local': start_date_string,
+        'distance': round(distance * 1000, 1),
+        'moving_time': elapsed_time,
+        'elapsed_time': elapsed_time,
+        'start_latlng': synthetic_latlng(rng),
+        'total_elevation_gain': round(rng.uniform(0, 15) * distance, 1),
+        'average_speed': round(1000 / pace, 3),
+        'max_speed': round(1000 / pace * rng.uniform(1.15, 1.6), 1),
+        'average_cadence': round(rng.uniform(80, 92), 1),
+        'kudos_count': rng.randint(0, 25),
+        'suffer_score': rng.randint(5, 250) if has_heartrate else None}
+
+    if has_heartrate:
+        activity['average_heartrate'] = average_heartrate
+        activity['max_heartrate'] = round(average_heartrate + rng.uniform(8, 25), 1)
+
+    return activity
+
+def synthetic_activities(first_id, last_id, seed = 0):
+
+    return [synthetic_activity(activity_id, seed) for activity_id in range(first_id, last_id + 1)]
+
+def start_time(activity):
+
+    return calendar.timegm(datetime.strptime(activity['start_date'], "%Y-%m-%dT%H:%M:%SZ").timetuple())
+
+def synthetic_activities_between(after, before, total_activities, seed = 0):
+
+    # narrowing to the ids that can start in the window (every 90 minutes, up to an hour late) before generating any
+    first_start = calendar.timegm(first_start_date.timetuple())
+    first_id = max(1, (after - first_start - 3600) // 5400) if after else 1
+    last_id = min(total_activities, (before - first_start) // 5400 + 1) if before else total_activities
+
+    activities = synthetic_activities(first_id, last_id, seed)
+
+    return [activity for activity in activities if (not after or start_time(activity) > after) and (not before or start_time(activity) < before)]
+
+# laps and zones
+
+def synthetic_laps(activity_id, seed = 0):
+
+    activity = synthetic_activity(activity_id, seed)
+    rng = activity_rng(activity_id, seed, 'laps')
+
+    # auto-lapping every kilometre, with a short final lap
+    distance = activity['distance']
+    n_laps = max(1, int(math.ceil(distance / 1000)))
+    laps = []
+
+    for i in range(1, n_laps + 1):
+        lap_distance = min(1000.0, distance - 1000 * (i - 1))
+        speed = activity['average_speed'] * rng.uniform(0.9, 1.1)
+        lap = {
+            'split': i,
+            'lap_index': i,
+            'distance': round(lap_distance, 1),
+            'elapsed_time': int(lap_distance / speed),
+            'moving_time': int(lap_distance / speed),
+            'total_elevation_gain': round(rng.uniform(0, 20), 1),
+            'average_speed': round(speed, 3),
+            'max_speed': round(speed * rng.uniform(1.05, 1.3), 3),
+            'average_cadence': round(activity['average_cadence'] + rng.uniform(-2, 2), 1)}
+        if 'average_heartrate' in activity:
+            lap['average_heartrate'] = round(activity['average_heartrate'] + rng.uniform(-8, 8), 1)
+            lap['max_heartrate'] = round(lap['average_heartrate'] + rng.uniform(3, 12), 1)
+        laps.append(lap)
+
+    return laps
+
+def bucket_times(rng, total_time, n_buckets):
+
+    # splitting the activity time between buckets
+    weights = [rng.random() ** 2 for _ in range(n_buckets)]
+    times = [int(total_time * weight / sum(weights)) for weight in weights]
+
+    return times
+
+def synthetic_zones(activity_id, seed = 0):
+
+    activity = synthetic_activity(activity_id, seed)
+    rng = activity_rng(activity_id, seed, 'zones')
+
+    heartrate_bounds = [(0, 136), (136, 152), (152, 167), (167, 182), (182, -1)]
+    pace_bounds = [(0, 3.35), (3.35, 3.9), (3.9, 4.35), (4.35, 4.65), (4.65, 4.95), (4.95, -1)]
+    zones = []
+
+    if 'average_heartrate' in activity:
+        times = bucket_times(rng, activity['elapsed_time'], len(heartrate_bounds))
+        zones.append({'type': 'heartrate', 'sensor_based': True, 'distribution_buckets': [{'min': low, 'max': high, 'time': time} for (low, high), time in zip(heartrate_bounds, times)]})
+
+    times = bucket_times(rng, activity['elapsed_time'], len(pace_bounds))
+    zones.append({'type': 'pace', 'sensor_based': True, 'distribution_buckets': [{'min': low, 'max': high, 'time': time} for (low, high), time in zip(pace_bounds, times)]})
+
+    return zones
+
+# geocoding
+
+def synthetic_geocode(latlng):
+
+    # answering with the nearest town, shaped like a Google Geocoding API reverse lookup
+    town = min(towns, key = lambda town: (town[1] - latlng[0]) ** 2 + (town[2] - latlng[1]) ** 2)[0]
+
+    return {
+        'results': [{
+            'address_components': [
+                {'long_name': '1', 'short_name': '1', 'types': ['street_number']},
+                {'long_name': 'High Street', 'short_name': 'High St', 'types': ['route']},
+                {'long_name': town, 'short_name': town, 'types': ['postal_town']},
+                {'long_name': 'Hertfordshire', 'short_name': 'Hertfordshire', 'types': ['administrative_area_level_2', 'political']},
+                {'long_name': 'United Kingdom', 'short_name': 'GB', 'types': ['country', 'political']}],
+            'formatted_address': "1 High St, {}, UK".format(town),
+            'geometry': {'location': {'lat': latlng[0], 'lng': latlng[1]}}}],
+        'status': 'OK'}
+
+# writing a dataset to disk
+
+def write_dataset(n, output_dir, seed = 0):
+
+    os.makedirs(output_dir, exist_ok = True)
+
+    # writing one json line per activity so millions of activities never sit in memory
+    with open(os.path.join(output_dir, 'activities.jsonl'), 'w') as activities_file, open(os.path.join(output_dir, 'laps_zones.jsonl'), 'w') as hydrations_file:
+        for activity_id in range(1, n + 1):
+            activities_file.write(json.dumps(synthetic_activity(activity_id, seed)) + "\n")
+            hydrations_file.write(json.dumps({'activity_id': activity_id, 'laps': synthetic_laps(activity_id, seed), 'zones': synthetic_zones(activity_id, seed)}) + "\n")
+
+    print("{} synthetic activities written to {}".format(n, output_dir))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Write synthetic Strava activities, laps and zones as json lines.')
+    parser.add_argument('--activities', type = int, default = 1000)
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--output', default = 'data/synthetic')
+    args = parser.parse_args()
+
+    write_dataset(args.activities, args.output, args.seed)
@@ -0,0 +1,61 @@
+# benchmarking per-dict vs columnar cleaning of activities, laps and zones
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import ETL_pipeline_functions
+from stub_server import stub_activity, stub_laps, stub_zones
+
+def per_dict_clean(activities, splits_by_activity, zones_by_activity):
+
+    clean_activities = [ETL_pipeline_functions.clean_activity(activity) for activity in activities]
+    clean_splits = [split for activity_id, splits in splits_by_activity for split in ETL_pipeline_functions.clean_splits(splits, activity_id)]
+    clean_zones = [zone for activity_id, zones in zones_by_activity for zone in ETL_pipeline_functions.clean_zones(zones, activity_id)]
+
+    return clean_activities, clean_splits, clean_zones
+
+def columnar_clean(activities, splits_by_activity, zones_by_activity):
+
+    clean_activities = ETL_pipeline_functions.clean_activities_frame(activities)
+    clean_splits = ETL_pipeline_functions.clean_splits_frame(splits_by_activity)
+    clean_zones = ETL_pipeline_functions.clean_zones_frame(zones_by_activity)
+
+    return clean_activities, clean_splits, clean_zones
+
+def timed(function, *args):
+
+    start = time.perf_counter()
+    output = function(*args)
+    elapsed = time.perf_counter() - start
+
+    return output, elapsed
+
+def main():
+
+    parser = argparse.ArgumentParser(description = 'Compare per-dict and columnar cleaning.')
+    parser.add_argument('--sizes', type = int, nargs = '+', default = [10000, 100000, 1000000], help = 'numbers of activities')
+    args = parser.parse_args()
+
+    print("{:>10} {:>12} {:>12} {:>8}".format('activities', 'per-dict', 'columnar', 'speedup'))
+
+    for n in args.sizes:
+        activities = [stub_activity(activity_id) for activity_id in range(1, n + 1)]
+        splits_by_activity = [(activity_id, stub_laps(activity_id)) for activity_id in range(1, n + 1)]
+        zones_by_activity = [(activity_id, stub_zones(activity_id)) for activity_id in range(1, n + 1)]
+
+        per_dict_output, per_dict_time = timed(per_dict_clean, activities, splits_by_activity, zones_by_activity)
+        columnar_output, columnar_time = timed(columnar_clean, activities, splits_by_activity, zones_by_activity)
+
+        # checking both paths produce the same rows
+        for records, frame in zip(per_dict_output, columnar_output):
+            assert records[:100] == ETL_pipeline_functions.frame_records(frame.head(100)), "columnar output differs from per-dict output"
+            assert len(records) == len(frame)
+
+        print("{:>10} {:>11.2f}s {:>11.2f}s {:>7.1f}x".format(n, per_dict_time, columnar_time, per_dict_time / columnar_time))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+# importing libaries
+
+import os
+import sys
+import json
+import argparse
+import psycopg2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app'))
+
+import queries
+
+# schema migrations, applied in order and recorded in the schema_migrations table
+
+## version, name and statements of each migration (append new ones, never edit applied ones)
+migrations = [
+    (1, 'create tables', [
+        """
+CREATE TABLE IF NOT EXISTS activities (
+    id bigint PRIMARY KEY,
+    timestamp timestamp,
+    distance real,
+    time int,
+    location text,
+    elevation_gain real,
+    average_speed real,
+    max_speed real,
+    average_hr int,
+    max_hr int,
+    average_cadence int,
+    kudos int,
+    suffer_score int,
+    run_type varchar(2),
+    position int,
+    event_type varchar(2),
+    chip_time int);""",
+        """
+CREATE TABLE IF NOT EXISTS activity_splits (
+    id serial PRIMARY KEY,
+    activity_id int,
+    split_index int,
+    distance real,
+    time int,
+    average_speed real,
+    max_speed real,
+    average_hr int,
+    max_hr int,
+    average_cadence real);""",
+        """
+CREATE TABLE IF NOT EXISTS activity_zones (
+    id serial PRIMARY KEY,
+    activity_id int,
+    zone_type text,
+    zone_index int,
+    time int);"""]),
+    (2, 'widen activity ids to bigint', [
+        # strava activity ids no longer fit in an int
+        """ALTER TABLE activity_splits ALTER COLUMN activity_id TYPE bigint;""",
+        """ALTER TABLE activity_zones ALTER COLUMN activity_id TYPE bigint;"""]),
+    (3, 'add split elevation gain', [
+        """ALTER TABLE activity_splits ADD COLUMN IF NOT EXISTS elevation_gain real;"""]),
+    (4, 'add athlete ids', [
+        """ALTER TABLE {} ADD COLUMN IF NOT EXISTS athlete_id bigint;""".format(table_name) for table_name in ['activities', 'activity_splits', 'activity_zones']]),
+    (5, 'create weekly rollups', [
+        """
+CREATE TABLE IF NOT EXISTS weekly_distance (
+    week timestamp PRIMARY KEY,
+    total_distance double precision,
+    moving_std double precision,
+    simple_moving_avg double precision,
+    linear_moving_avg double precision,
+    exp_moving_avg double precision);""",
+        """
+CREATE TABLE IF NOT EXISTS weekly_zone_time (
+    week timestamp,
+    zone int,
+    time bigint,
+    moving_time numeric,
+    moving_total numeric,
+    moving_percentage numeric,
+    PRIMARY KEY (week, zone));"""]),
+    (6, 'index dashboard filters and joins', [
+        """CREATE INDEX IF NOT EXISTS activities_timestamp_idx ON activities (timestamp);""",
+        """CREATE INDEX IF NOT EXISTS activities_event_type_location_timestamp_idx ON activities (event_type, location, timestamp);""",
+        """CREATE INDEX IF NOT EXISTS activity_splits_activity_id_split_index_idx ON activity_splits (activity_id, split_index);""",
+        """CREATE INDEX IF NOT EXISTS activity_zones_activity_id_zone_type_idx ON activity_zones (activity_id, zone_type);"""])
+]
+
+## indexes each app query is expected to use
+expected_indexes = {
+    'weekly_distance_query': ['weekly_distance_pkey'],
+    'monthly_run_types_query': ['activities_timestamp_idx'],
+    'weekly_zone_time_query': ['weekly_zone_time_pkey'],
+    'parkrun_splits_query': ['activities_event_type_location_timestamp_idx', 'activity_splits_activity_id_split_index_idx'],
+    'parkrun_progress_query': ['activities_event_type_location_timestamp_idx'],
+    'parkrun_best_times_query': ['activities_event_type_location_timestamp_idx']
+}
+
+def schema_version(conn):
+
+    with conn.cursor() as cur:
+        cur.execute("""
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    version int PRIMARY KEY,
+    name text,
+    applied_at timestamp DEFAULT now());""")
+        cur.execute("""SELECT coalesce(MAX(version), 0) FROM schema_migrations;""")
+        version = cur.fetchone()[0]
+    conn.commit()
+
+    return version
+
+def migrate(conn, target_version = None):
+
+    target_version = target_version or migrations[-1][0]
+    applied = []
+
+    # creating the schema_migrations table on a fresh database
+    schema_version(conn)
+
+    for version, name, statements in migrations:
+        if version > target_version:
+            break
+
+        with conn.cursor() as cur:
+            # holding a lock so two pipelines starting together don't apply the same migration twice
+            cur.execute("""SELECT pg_advisory_xact_lock(hashtext('schema_migrations'));""")
+            cur.execute("""SELECT 1 FROM schema_migrations WHERE version = %s;""", (version,))
+            if cur.fetchone():
+                conn.commit()
+                continue
+
+            # applying each migration in its own transaction, so a failure leaves the schema at the previous version
+            try:
+                for statement in statements:
+                    cur.execute(statement)
+                cur.execute("""INSERT INTO schema_migrations (version, name) VALUES (%s, %s);""", (version, name))
+            except psycopg2.Error:
+                conn.rollback()
+                raise
+        conn.commit()
+
+        applied.append(version)
+        print("migration {} applied ({})".format(version, name))
+
+    return applied
+
+# checking the indexes the app's queries rely on
+
+def plan_indexes(plan):
+
+    # collecting index names from every node of an EXPLAIN (FORMAT JSON) plan
+    indexes = [plan['Index Name']] if 'Index Name' in plan else []
+    for sub_plan in plan.get('Plans', []):
+        indexes += plan_indexes(sub_plan)
+
+    return indexes
+
+def explain_check(conn):
+
+    missing = {}
+
+    with conn.cursor() as cur:
+        cur.execute("""SELECT indexname FROM pg_indexes WHERE schemaname = current_schema();""")
+        existing = set(row[0] for row in cur.fetchall())
+
+        for query_name, indexes in expected_indexes.items():
+            # failing only on indexes that don't exist, as the planner rightly prefers sequential scans while tables are small
+            absent = [index for index in indexes if index not in existing]
+            if absent:
+                missing[query_name] = absent
+
+            # showing which indexes the planner picks at its normal settings, for the data as it is now
+            cur.execute("""EXPLAIN (FORMAT JSON) {}""".format(getattr(queries, query_name)))
+            plan = cur.fetchone()[0]
+            plan = json.loads(plan) if isinstance(plan, str) else plan
+            used = sorted(set(plan_indexes(plan[0]['Plan'])))
+
+            print("{:<26} {:<40} planner uses {}".format(query_name, 'ok' if not absent else 'missing ' + ', '.join(absent), ', '.join(used) or 'no index'))
+
+    conn.rollback()
+
+    return missing
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Create or upgrade the running_data schema.')
+    parser.add_argument('--dsn', help = 'postgres dsn (defaults to the local running_data database)')
+    parser.add_argument('--target', type = int, help = 'version to migrate up to (defaults to the latest)')
+    parser.add_argument('--check', action = 'store_true', help = "check the indexes the app's queries rely on exist, and show which ones the planner picks")
+    args = parser.parse_args()
+
+    # creating connection to postgresSQL database
+    if args.dsn:
+        conn = psycopg2.connect(args.dsn)
+    else:
+        conn = psycopg2.connect(host="localhost", database="running_data", user="jacktann", password="Buster#19")
+
+    print("schema at version {}".format(schema_version(conn)))
+    migrate(conn, args.target)
+    print("schema at version {}".format(schema_version(conn)))
+
+    if args.check and explain_check(conn):
+        conn.close()
+        sys.exit(1)
+
+    conn.close()
@@ -0,0 +1,88 @@
+# checking laps and zones error responses never reach the staged files or the transform stage
+
+import os
+import sys
+import json
+
+import pytest
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ETL_pipeline
+import ETL_pipeline_functions
+
+not_found_body = {'message': 'Record Not Found', 'errors': [{'resource': 'Activity', 'field': 'id', 'code': 'invalid'}]}
+laps_body = [{'split': 1, 'distance': 1000.0, 'elapsed_time': 300, 'average_speed': 3.3, 'max_speed': 4.0}]
+zones_body = [{'type': 'heartrate', 'distribution_buckets': [{'min': 0, 'max': 120, 'time': 60}, {'min': 120, 'max': -1, 'time': 240}]}]
+
+def fake_response(status_code, body):
+
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = json.dumps(body).encode()
+
+    return response
+
+def fake_http_request(status_codes):
+
+    # answering laps and zones requests, with the given status code for chosen activity ids
+    def http_request(method, url, **kwargs):
+        activity_id = int(url.split('/')[-2])
+        if activity_id in status_codes:
+            return fake_response(status_codes[activity_id], not_found_body if status_codes[activity_id] == 404 else {'message': 'error'})
+        return fake_response(200, laps_body if url.endswith('/laps') else zones_body)
+
+    return http_request
+
+def staged_activities(tmp_path, activity_ids):
+
+    activities_file = str(tmp_path / 'activities_raw.jsonl')
+    ETL_pipeline_functions.write_jsonl([{'id': activity_id} for activity_id in activity_ids], activities_file)
+
+    return activities_file
+
+def transformed(hydrations):
+
+    hydrations = ETL_pipeline.valid_hydrations(hydrations)
+    splits = ETL_pipeline_functions.clean_splits_frame([(hydration['activity_id'], hydration['laps']) for hydration in hydrations])
+    zones = ETL_pipeline_functions.clean_zones_frame([(hydration['activity_id'], hydration['zones']) for hydration in hydrations])
+
+    return ETL_pipeline_functions.frame_records(splits), ETL_pipeline_functions.frame_records(zones)
+
+def test_deleted_activity_is_not_staged(tmp_path, monkeypatch):
+
+    monkeypatch.setattr(ETL_pipeline_functions, 'http_request', fake_http_request({1: 404}))
+    activities_file = staged_activities(tmp_path, [1, 2])
+    hydrations_file = str(tmp_path / 'laps_zones_raw.jsonl')
+
+    ETL_pipeline.hydrate_activities(activities_file, hydrations_file, 'token')
+    hydrations = list(ETL_pipeline_functions.read_jsonl(hydrations_file))
+    splits, zones = transformed(hydrations)
+
+    assert [hydration['activity_id'] for hydration in hydrations] == [2]
+    assert set(split['activity_id'] for split in splits) == {2}
+    assert set(zone['activity_id'] for zone in zones) == {2}
+
+def test_server_error_is_raised_and_retried_on_resume(tmp_path, monkeypatch):
+
+    activities_file = staged_activities(tmp_path, [1, 2])
+    hydrations_file = str(tmp_path / 'laps_zones_raw.jsonl')
+
+    monkeypatch.setattr(ETL_pipeline_functions, 'http_request', fake_http_request({2: 503}))
+    with pytest.raises(requests.HTTPError):
+        ETL_pipeline.hydrate_activities(activities_file, hydrations_file, 'token')
+    assert [hydration['activity_id'] for hydration in ETL_pipeline_functions.read_jsonl(hydrations_file)] == [1]
+
+    # resuming once the server recovers requests only the activity that failed
+    monkeypatch.setattr(ETL_pipeline_functions, 'http_request', fake_http_request({}))
+    ETL_pipeline.hydrate_activities(activities_file, hydrations_file, 'token')
+    assert [hydration['activity_id'] for hydration in ETL_pipeline_functions.read_jsonl(hydrations_file)] == [1, 2]
+
+def test_error_bodies_staged_by_earlier_runs_are_dropped():
+
+    hydrations = [{'activity_id': 1, 'laps': not_found_body, 'zones': not_found_body}, {'activity_id': 2, 'laps': laps_body, 'zones': zones_body}]
+    splits, zones = transformed(hydrations)
+
+    assert set(split['activity_id'] for split in splits) == {2}
+    assert set(zone['activity_id'] for zone in zones) == {2}
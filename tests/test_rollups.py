@@ -0,0 +1,89 @@
+# checking incrementally refreshed weekly rollups match a full rebuild (needs a postgres database, e.g. TEST_DSN='dbname=running_data_test')
+
+import os
+import sys
+import random
+from datetime import datetime, timedelta
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ETL_pipeline_functions
+import migrations
+
+psycopg2 = pytest.importorskip('psycopg2')
+
+if not os.environ.get('TEST_DSN'):
+    pytest.skip('TEST_DSN not set', allow_module_level = True)
+
+first_week = datetime(2020, 1, 6)
+
+@pytest.fixture
+def conn():
+
+    conn = psycopg2.connect(os.environ['TEST_DSN'])
+
+    with conn.cursor() as cur:
+        cur.execute("DROP SCHEMA IF EXISTS rollups_test CASCADE; CREATE SCHEMA rollups_test; SET search_path TO rollups_test;")
+    conn.commit()
+    migrations.migrate(conn)
+
+    yield conn
+
+    conn.rollback()
+    with conn.cursor() as cur:
+        cur.execute("DROP SCHEMA rollups_test CASCADE;")
+    conn.commit()
+    conn.close()
+
+def synthetic_history(n_weeks, seed = 0):
+
+    rng = random.Random(seed)
+    activities = []
+    zones = []
+
+    # up to a few runs a week, with empty weeks in between (so deletions open gaps at the start of the history)
+    for week in range(n_weeks):
+        for run in range(rng.choice([0, 0, 1, 1, 2, 3])):
+            activity_id = len(activities) + 1
+            timestamp = first_week + timedelta(weeks = week, days = rng.randint(0, 6), hours = rng.randint(6, 20))
+            activities.append({'id': activity_id, 'timestamp': timestamp.strftime('%Y-%m-%d %H:%M:%S'), 'distance': round(rng.uniform(3, 25), 2), 'time': rng.randint(900, 7200)})
+            zones += [{'activity_id': activity_id, 'zone_type': 'heartrate', 'zone_index': zone, 'time': rng.randint(0, 1200)} for zone in range(1, 6)]
+
+    return activities, zones
+
+def load_history(conn, activities, zones, batch_size):
+
+    for batch in ETL_pipeline_functions.batched(activities, batch_size):
+        batch_ids = set(activity['id'] for activity in batch)
+        ETL_pipeline_functions.bulk_load(conn, batch, [], [zone for zone in zones if zone['activity_id'] in batch_ids])
+
+def earliest(activities):
+
+    return min(activities, key = lambda activity: activity['timestamp'])
+
+def latest(activities):
+
+    return max(activities, key = lambda activity: activity['timestamp'])
+
+def test_newest_first_load_matches_rebuild(conn):
+
+    activities, zones = synthetic_history(40)
+    load_history(conn, sorted(activities, key = lambda activity: activity['timestamp'], reverse = True), zones, 5)
+
+    assert ETL_pipeline_functions.verify_rollups(conn) == {}
+
+@pytest.mark.parametrize('pick', [earliest, latest, lambda activities: activities[len(activities) // 2]])
+def test_deletions_match_rebuild(conn, pick):
+
+    activities, zones = synthetic_history(40)
+    load_history(conn, activities, zones, 10)
+
+    # deleting one activity at a time, so the start or end of the history moves several times
+    for _ in range(5):
+        activity = pick(activities)
+        activities.remove(activity)
+        ETL_pipeline_functions.delete_activities(conn, [activity['id']])
+
+        assert ETL_pipeline_functions.verify_rollups(conn) == {}